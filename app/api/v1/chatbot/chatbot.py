@@ -1,15 +1,19 @@
 from fastapi import APIRouter,status,BackgroundTasks,Response
 from app.schemas.chat import ChatRequest,WebhookRequest
 from app.core.logging import logger
-from app.core.langgraph.graph import agent,client
+from app.core.metrics import metrics
+from app.core.langgraph.graph import agent,client,llm
 from app.core.omnidesk.omnidesk_api import omnidesk_api
-from app.api.v1.chatbot.helper import get_message_type,is_working_hours
-from langchain_core.messages import HumanMessage,AIMessage
-import io
+from app.api.v1.chatbot.helper import get_message_type,is_working_hours,get_attachment_urls,IMAGE_EXTENSIONS,AUDIO_EXTENSIONS
+from langchain_core.messages import HumanMessage,SystemMessage
+import asyncio
+import base64
+import hashlib
 from app.models.redis_helper import redis_helper
 from datetime import datetime, timedelta, timezone
 
 from app.api.v1.chatbot.labels import OUTSIDE_WORKING_HOURS_RESPONSE
+from app.api.v1.chatbot.image_preprocess import PREPROCESS_SETTINGS,prepare_image
 
 
 router = APIRouter()
@@ -29,35 +33,108 @@ async def recieve_webhook(webhook_request:WebhookRequest):
     return Response("accepted",status_code=status.HTTP_200_OK)
 
 
+@router.get("/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
+
+IMAGE_SYSTEM_PROMPT = "ТЫ ИИ АССИСТЕНТ КОТОРЫЙ ПРИНИМАЕТ ФОТОГРАФИЙ , КАРТИНКИ , СКРИНШОТЫ\n\n ТВОЯ ЗАДАЧА ДАТЬ ОПИСАНИЕ КАРТИНКИ по шаблону : на image показан ... итд"
+IMAGE_USER_PROMPT = "Опиши прикрепленную image"
+TRANSCRIBE_MODEL = "gpt-4o-transcribe"
+
+
+async def describe_image(file):
+    image = await prepare_image(file)
+    image_data = base64.b64encode(image.data).decode(encoding="utf-8")
+    message = HumanMessage(content=[
+            {"type": "text", "text": IMAGE_USER_PROMPT},
+            {"type": "image_url", "image_url": {"url": f"data:{image.mime};base64,{image_data}", "detail": image.detail}}
+        ]) 
+    system_message = SystemMessage(content=IMAGE_SYSTEM_PROMPT)
+    result = await agent.ainvoke({"last_message": message,"system_message":system_message})
+    return result["response"]
+
+
+async def transcribe_audio(name:str, file):
+    # файл уходит в multipart как есть, без копии в BytesIO
+    transcription = await client.audio.transcriptions.create(
+            model = TRANSCRIBE_MODEL,
+            file=(name or "audio.mp3", file)
+        )
+    return transcription.text
+
+
+# версия входит в ключ кэша: новый промпт, модель или настройки подготовки — новые описания
+ATTACHMENT_CACHE_VERSIONS = {
+    "image": hashlib.sha256(
+        f"{IMAGE_SYSTEM_PROMPT}:{IMAGE_USER_PROMPT}:{llm.model_name}:{PREPROCESS_SETTINGS}".encode("utf-8")
+    ).hexdigest()[:12],
+    "audio": TRANSCRIBE_MODEL,
+}
+
+
+async def file_sha256(file) -> str:
+    """SHA-256 вложения; файл читается кусками, в потоке — он может лежать на диске"""
+    file.seek(0)
+    digest = await asyncio.to_thread(hashlib.file_digest, file, "sha256")
+    file.seek(0)
+    return digest.hexdigest()
+
+
+async def get_attachment_content(msg_type:str, digest:str, name:str, file):
+    """Описание картинки или расшифровка аудио из кэша по хэшу содержимого, иначе через модель"""
+    version = ATTACHMENT_CACHE_VERSIONS[msg_type]
+    cached = await redis_helper.get_attachment_content(msg_type, version, digest)
+    if cached is not None:
+        metrics.inc(f"{msg_type}_cache_hits")
+        return cached
+    metrics.inc(f"{msg_type}_cache_misses")
+    if msg_type == "image":
+        content = await describe_image(file)
+    else:
+        content = await transcribe_audio(name, file)
+    await redis_helper.set_attachment_content(msg_type, version, digest, content)
+    return content
+
+
 async def get_content_by_msg_type(msg_type:str,chat_request:ChatRequest):
     if msg_type == "text":
         return chat_request.last_message
-    
-    elif msg_type == "image":
-        image_data = await omnidesk_api.download_image(last_message=chat_request.last_message)
-        message = HumanMessage(content=[
-                {"type": "text", "text": "Опиши прикрепленную image"},
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data}"}}
-            ]) 
-        system_message = AIMessage(
-                content="ТЫ ИИ АССИСТЕНТ КОТОРЫЙ ПРИНИМАЕТ ФОТОГРАФИЙ , КАРТИНКИ , СКРИНШОТЫ\n\n ТВОЯ ЗАДАЧА ДАТЬ ОПИСАНИЕ КАРТИНКИ по шаблону : на image показан ... итд"
-            )
-        result = await agent.ainvoke({"last_message": message,"system_message":system_message})
-        content = result["response"]
-        return content
-        
-    elif msg_type == "audio":
-        audio_data = await omnidesk_api.download_audio(last_message=chat_request.last_message)
-            
-        audio_file = io.BytesIO(audio_data)
-        audio_file.name = "audio.mp3"
-            
-        transcription = await client.audio.transcriptions.create(
-                model = "gpt-4o-transcribe",
-                file=audio_file
-            )
-        
-        return transcription.text                    
+
+    extensions = IMAGE_EXTENSIONS if msg_type == "image" else AUDIO_EXTENSIONS
+    attachments = await omnidesk_api.download_attachments(
+        get_attachment_urls(chat_request.last_message, extensions)
+    )
+    if not attachments:
+        logger.error(f"No attachments downloaded for chat_request {chat_request.chat_id}")
+        return chat_request.last_message
+
+    try:
+        digests = await asyncio.gather(*(file_sha256(file) for _, file in attachments))
+        # одинаковые вложения в одном сообщении обрабатываются один раз
+        unique = {}
+        for digest, attachment in zip(digests, attachments):
+            unique.setdefault(digest, attachment)
+        results = await asyncio.gather(*(
+            get_attachment_content(msg_type, digest, name, file)
+            for digest, (name, file) in unique.items()
+        ), return_exceptions=True)
+    finally:
+        for _, file in attachments:
+            file.close()
+
+    # неудачное вложение пропускается, остальные всё равно попадают в буфер
+    by_digest = {}
+    for (digest, (name, _)), result in zip(unique.items(), results):
+        if isinstance(result, Exception):
+            metrics.inc(f"{msg_type}_errors")
+            logger.error(f"Error processing {msg_type} {name} for chat_request {chat_request.chat_id}: {str(result)}")
+        else:
+            by_digest[digest] = result
+    contents = [by_digest[digest] for digest in digests if digest in by_digest]
+    if not contents:
+        return chat_request.last_message
+    return "\n".join(contents)
     
 async def chat_process(chat_request:ChatRequest):
     logger.info(f"chat_process started for chat_request {chat_request.chat_id} ")
@@ -33,6 +33,8 @@ async def save_message(
     last_message: str,
     response: str,
     retrieved: list[int],
+    embedding: bytes | None = None,
+    embedding_model: str | None = None,
 ):
     await get_or_create_user(session, user_id)
     await get_or_create_chat(session, chat_id, user_id)
@@ -43,6 +45,8 @@ async def save_message(
         message=last_message,
         response=response,
         retrieved=retrieved,
+        embedding=embedding,
+        embedding_model=embedding_model,
     )
 
     logger.debug(f"message: {msg}")
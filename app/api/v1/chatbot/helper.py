@@ -6,6 +6,11 @@ from datetime import datetime,timezone
 WORK_START = 9
 WORK_END = 19
 
+QUESTION_MIN_WORDS = 4
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp")
+AUDIO_EXTENSIONS = (".mp3", ".mpeg", ".wav", ".ogg", ".m4a",".opus")
+
 async def get_message_type(last_message:str) -> str:
     """
     Классифицирует сообщение:
@@ -18,14 +23,34 @@ async def get_message_type(last_message:str) -> str:
     
     for url in urls:
         if "attachment/download/chat/" in url:
-            if url.lower().endswith((".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp")):
+            if url.lower().endswith(IMAGE_EXTENSIONS):
                 return "image"
-            elif url.lower().endswith((".mp3", ".mpeg", ".wav", ".ogg", ".m4a",".opus")):
+            elif url.lower().endswith(AUDIO_EXTENSIONS):
                 return "audio"    
     return "text"    
 
 
+def get_attachment_urls(last_message:str, extensions:tuple) -> list[str]:
+    """Все ссылки на вложения чата с нужными расширениями, без повторов"""
+    urls = re.findall(r'https?://\S+',last_message)
+    return list(dict.fromkeys(
+        url for url in urls
+        if "attachment/download/chat/" in url and url.lower().endswith(extensions)
+    ))
+
+
 def is_working_hours(dt:datetime) -> bool:
     hour = dt.hour
     return WORK_START <= hour < WORK_END
-    
\ No newline at end of file
+
+
+def is_complete_question(text:str) -> bool:
+    """
+    Сообщение похоже на законченный вопрос:
+    заканчивается на «?» и содержит хотя бы QUESTION_MIN_WORDS слов.
+    Такие сообщения не ждут полного окна буфера.
+    """
+    text = (text or "").strip()
+    if not text.endswith("?"):
+        return False
+    return len(text.split()) >= QUESTION_MIN_WORDS
@@ -0,0 +1,123 @@
+import asyncio
+import io
+import math
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from PIL import Image, ImageOps
+
+from app.core.config import settings
+from app.core.logging import logger
+from app.core.metrics import metrics
+
+# gpt-4o vision: в режиме high картинка вписывается в 2048x2048, затем короткая
+# сторона уменьшается до 768 и считается по 170 токенов за плитку 512x512 + 85;
+# режим low — всегда 85 токенов, картинка 512x512
+MAX_SIDE = 2048
+SHORT_SIDE = 768
+LOW_DETAIL_SIDE = 512
+TILE = 512
+
+# всё, от чего зависит подготовленная картинка; входит в ключ кэша описаний
+PREPROCESS_SETTINGS = (
+    f"{MAX_SIDE}:{SHORT_SIDE}:{LOW_DETAIL_SIDE}:"
+    f"{settings.IMAGE_FORMAT}:{settings.IMAGE_QUALITY}:{settings.IMAGE_DETAIL}"
+)
+
+# декодирование и сжатие — CPU-работа, в event loop ей не место
+executor = ThreadPoolExecutor(max_workers=settings.IMAGE_WORKERS, thread_name_prefix="image")
+
+
+@dataclass
+class PreparedImage:
+    data: bytes
+    mime: str
+    detail: str
+
+
+def effective_size(width: int, height: int) -> tuple[int, int]:
+    """Размер, до которого модель сама уменьшит картинку в режиме high"""
+    scale = min(1.0, MAX_SIDE / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, SHORT_SIDE / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def vision_tokens(width: int, height: int, detail: str) -> int:
+    if detail == "low":
+        return 85
+    width, height = effective_size(width, height)
+    return 85 + 170 * math.ceil(width / TILE) * math.ceil(height / TILE)
+
+
+def prepare_image_sync(file) -> tuple[PreparedImage, tuple[int, int]]:
+    """Читает картинку прямо из файла вложения: уменьшает, убирает прозрачность, пережимает"""
+    image = Image.open(file)
+    original_size = image.size
+    # JPEG можно декодировать сразу в уменьшенном масштабе; квадрат по короткой
+    # стороне, потому что EXIF-поворот ещё может поменять стороны местами
+    short_side = min(effective_size(*original_size))
+    image.draft("RGB", (short_side, short_side))
+    image = ImageOps.exif_transpose(image)
+    target = effective_size(*image.size)
+    if image.mode != "RGB":
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    if image.size != target:
+        image = image.resize(target, Image.Resampling.LANCZOS)
+
+    detail = settings.IMAGE_DETAIL
+    if detail == "auto":
+        # мелкая картинка целиком влезает в low — те же пиксели за 85 токенов
+        detail = "low" if max(target) <= LOW_DETAIL_SIDE else "high"
+
+    buffer = io.BytesIO()
+    image_format = settings.IMAGE_FORMAT.upper()
+    image.save(buffer, format=image_format, quality=settings.IMAGE_QUALITY, optimize=True)
+    prepared = PreparedImage(
+        data=buffer.getvalue(), mime=f"image/{image_format.lower()}", detail=detail
+    )
+    return prepared, original_size
+
+
+def read_original(file) -> PreparedImage:
+    try:
+        file.seek(0)
+        # open читает только заголовок
+        mime = Image.MIME.get(Image.open(file).format, "image/jpeg")
+    except Exception:
+        mime = "image/jpeg"
+    file.seek(0)
+    return PreparedImage(data=file.read(), mime=mime, detail="auto")
+
+
+async def prepare_image(file) -> PreparedImage:
+    """Уменьшает и пережимает картинку перед vision-запросом; при ошибке отдаёт оригинал"""
+    loop = asyncio.get_running_loop()
+    original_bytes = file.seek(0, io.SEEK_END)
+    file.seek(0)
+    try:
+        with metrics.timer("image_preprocess_seconds"):
+            prepared, (width, height) = await loop.run_in_executor(
+                executor, prepare_image_sync, file
+            )
+    except Exception as e:
+        logger.error(f"Error preprocessing image, sending original: {str(e)}")
+        metrics.inc("image_preprocess_errors")
+        return await loop.run_in_executor(executor, read_original, file)
+
+    if len(prepared.data) >= original_bytes:
+        # пережатие не помогло — оригинал не хуже, модель уменьшит его сама
+        original = await loop.run_in_executor(executor, read_original, file)
+        prepared.data, prepared.mime = original.data, original.mime
+    bytes_saved = original_bytes - len(prepared.data)
+    tokens_saved = vision_tokens(width, height, "high") - vision_tokens(width, height, prepared.detail)
+    metrics.inc("image_bytes_saved", bytes_saved)
+    metrics.inc("image_tokens_saved", tokens_saved)
+    logger.debug(
+        f"Image {width}x{height}: {original_bytes} -> {len(prepared.data)} bytes, "
+        f"detail {prepared.detail}, {tokens_saved} tokens saved"
+    )
+    return prepared
@@ -0,0 +1,117 @@
+import re
+from datetime import datetime, timedelta
+from typing import Optional
+from zoneinfo import ZoneInfo
+
+GREETING_WORDS = [
+    "привет",
+    "здравствуйте",
+    "здравствуй",
+    "доброе утро",
+    "добрый день",
+    "добрый вечер",
+    "хай",
+    "hello",
+    "hi",
+    "good morning",
+    "good afternoon",
+    "good evening",
+    "сәлем",
+    "сәлеметсіз бе",
+    "сәлеметсізбе",
+    "салеметсизбе",
+    "кайырлы кун",
+    "қайырлы күн",
+]
+INTRO_WORDS = ["я ai-ассистент trustme", "мен ai-ассистент trustme", "ai assistant"]
+
+# правила сами добавляют приветствие только к русскому ответу; для казахского
+# и английского уместное приветствие подбирает LLM-фильтр
+GREETING = "Здравствуйте! Я AI-ассистент TrustMe."
+
+# приветствие в начале ответа: "Здравствуйте!", "Добрый день, Айгерим!",
+# опционально вместе с представлением "Я AI-ассистент TrustMe." / "Мен AI-ассистент TrustMe."
+_GREETING_ALTERNATION = "|".join(
+    re.escape(g) for g in sorted(GREETING_WORDS, key=len, reverse=True)
+)
+_NAME = r"[A-ZА-ЯЁӘҒҚҢӨҰҮҺІ][^\s!.?,]*"
+_LEADING_GREETING = re.compile(
+    rf"^\s*(?i:{_GREETING_ALTERNATION})\b(?:,\s*{_NAME}(?:\s+{_NAME}){{0,2}}\s*[!.])?\s*[!.,]*\s*"
+)
+_INTRO = (
+    r"(?:я|мен)\s+(?:trustme\s+)?ai-ассистент\w*(?:\s+trustme)?"
+    r"|i(?:'m|\s+am)\s+(?:the\s+)?(?:trustme\s+)?ai[- ]assistant(?:\s+(?:of|at|from)\s+trustme|\s+trustme)?"
+)
+_LEADING_INTRO = re.compile(rf"^\s*(?:{_INTRO})\s*[.!]?\s*", re.IGNORECASE)
+_ANY_GREETING = re.compile(rf"\b(?:{_GREETING_ALTERNATION})\b|{_INTRO}", re.IGNORECASE)
+
+_KAZAKH_LETTERS = re.compile(r"[әғқңөұүһі]", re.IGNORECASE)
+_CYRILLIC = re.compile(r"[а-яё]", re.IGNORECASE)
+
+_BULLET = re.compile(r"^(\s*)[*•]\s+", re.MULTILINE)
+
+
+def found_recent_greeting(history: list, current_time: datetime) -> bool:
+    """Было ли приветствие в переписке за последний час"""
+    recent_threshold = current_time - timedelta(hours=1)
+    for msg in history[-10:]:
+        try:
+            msg_time = msg.created_at.astimezone(ZoneInfo("Asia/Almaty"))
+        except Exception:
+            msg_time = current_time
+        if msg_time >= recent_threshold:
+            text = (msg.message or "").lower()
+            response_text = (msg.response or "").lower()
+            words = GREETING_WORDS + INTRO_WORDS
+            if any(g in text for g in words) or any(g in response_text for g in words):
+                return True
+    return False
+
+
+def strip_markdown(text: str) -> str:
+    """Убирает звёздочки: маркеры списков заменяются на «-», выделение снимается"""
+    text = _BULLET.sub(r"\1- ", text)
+    return text.replace("*", "")
+
+
+def strip_greeting(text: str) -> str:
+    while True:
+        stripped = _LEADING_INTRO.sub("", _LEADING_GREETING.sub("", text, count=1), count=1)
+        if stripped == text:
+            return text
+        text = stripped
+
+
+def is_russian(text: str) -> bool:
+    """Кириллица без казахских букв; английский и казахский ответы — нет"""
+    return bool(_CYRILLIC.search(text)) and not _KAZAKH_LETTERS.search(text)
+
+
+def first_sentence(text: str) -> str:
+    return re.split(r"[.!?\n]", text.strip(), maxsplit=1)[0]
+
+
+def postprocess_response(text: str, recent_greeting: bool) -> Optional[str]:
+    """
+    Детерминированная замена LLM-фильтра ответа:
+    - если приветствие уже было недавно — убирает приветствие в начале;
+    - иначе добавляет GREETING, если русский ответ не начинается с приветствия;
+    - убирает звёздочки.
+    Возвращает None, если правила не могут решить однозначно (приветствие стоит
+    не в начале ответа или нужно приветствие не на русском) — тогда нужен LLM.
+    """
+    text = strip_markdown(text or "").strip()
+    if not text:
+        return None
+
+    if recent_greeting:
+        cleaned = strip_greeting(text).strip()
+        if not cleaned or _ANY_GREETING.search(first_sentence(cleaned)):
+            return None
+        return cleaned[0].upper() + cleaned[1:]
+
+    if _LEADING_GREETING.match(text):
+        return text
+    if _ANY_GREETING.search(first_sentence(text)) or not is_russian(text):
+        return None
+    return f"{GREETING}\n\n{text}"
@@ -0,0 +1,102 @@
+import re
+
+from app.api.v1.chatbot.labels import SYSTEM_PROMPT_V4
+from app.core.config import settings
+from app.core.logging import logger
+from app.core.metrics import metrics
+from app.models.catalog_index import CatalogIndex
+from app.models.qdrant_helper import qdrant_helper
+
+# SYSTEM_PROMPT_V4 = постоянное ядро + библиотека правил по кейсам ("[Баг] ...").
+# Ядро уходит в каждый запрос, из библиотеки — только правила, подходящие к сообщению.
+RULES_HEADER = "ДОПОЛНИТЕЛЬНЫЕ ПРАВИЛА: ОБРАБОТКА КЕЙСОВ (ошибки, баги, интеграции)"
+
+_core, _, _rules_section = SYSTEM_PROMPT_V4.partition(RULES_HEADER)
+SYSTEM_PROMPT_CORE = _core.rstrip() + "\n"
+RULES_INTRO, RULES = _rules_section.strip().split("\n\n", 1)
+
+_TAG = re.compile(r"^\[[^\]]+\]\s*")
+_DATE = re.compile(r"\b\d{1,2}\.\d{2}(?:\.\d{2,4})?\b")
+_WORD = re.compile(r"\w+")
+# основы, которые есть почти в любом обращении и ничего не говорят о кейсе
+STOP_STEMS = {"без", "мои", "компан", "пробле", "сервис", "запраш", "функци", "права", "номера", "телефо", "докуме"}
+
+
+def parse_rules(rules: str) -> dict[str, str]:
+    """Одно правило на строку: {строка правила: паттерн кейса до «—»}"""
+    return {
+        line.strip(): line.split(" — ", 1)[0].strip()
+        for line in rules.splitlines()
+        if line.strip()
+    }
+
+
+def stems(text: str) -> set[str]:
+    """Грубая основа слова (первые 6 символов) — хватает, чтобы «загружается» совпало с «загрузка»"""
+    return {word[:6] for word in _WORD.findall(_DATE.sub(" ", text.lower())) if len(word) >= 3}
+
+
+def rule_keywords(rules: dict[str, str]) -> dict[str, set[str]]:
+    """Ключевые слова правила — основы из его паттерна, которые встречаются не более чем в двух правилах"""
+    rule_stems = {rule: stems(_TAG.sub("", pattern)) for rule, pattern in rules.items()}
+    frequency: dict[str, int] = {}
+    for words in rule_stems.values():
+        for word in words:
+            frequency[word] = frequency.get(word, 0) + 1
+    return {
+        rule: {word for word in words if frequency[word] <= 2 and word not in STOP_STEMS}
+        for rule, words in rule_stems.items()
+    }
+
+
+RULE_PATTERNS = parse_rules(RULES)
+RULE_ORDER = {rule: i for i, rule in enumerate(RULE_PATTERNS)}
+RULE_KEYWORDS = rule_keywords(RULE_PATTERNS)
+
+rule_index = CatalogIndex(catalog=RULES, parse=parse_rules, name="prompt_rule_index")
+
+
+async def select_rules(query: str) -> list[str]:
+    """Правила, чьи ключевые слова есть в сообщении, плюс ближайшие по эмбеддингу"""
+    query_stems = stems(query)
+    selected = [rule for rule, words in RULE_KEYWORDS.items() if words & query_stems]
+
+    # вектор другой модели индекс не сравнивает — тогда остаются только ключевые слова
+    embedding, model = await qdrant_helper.embed_query(query_str=query)
+    matches = await rule_index.top_k(embedding, model=model, k=settings.PROMPT_RULES_TOP_K)
+    for rule, _, score in matches:
+        if score >= settings.PROMPT_RULES_MIN_SCORE:
+            selected.append(rule)
+
+    # совпадения по ключевым словам важнее; затем порядок как в библиотеке,
+    # чтобы одинаковый набор правил давал одинаковый промпт
+    selected = list(dict.fromkeys(selected))[: settings.PROMPT_RULES_MAX]
+    return sorted(selected, key=RULE_ORDER.__getitem__)
+
+
+def rules_section(rules: list[str]) -> str:
+    if not rules:
+        return ""
+    return f"{RULES_HEADER}\n\n{RULES_INTRO}\n\n" + "\n".join(rules) + "\n"
+
+
+async def build_system_prompt(query: str) -> tuple[str, str]:
+    """
+    Системный промпт из двух частей: постоянное ядро и подходящие правила по кейсам.
+    Ядро не меняется между запросами, поэтому провайдер кэширует его как префикс.
+    """
+    if not settings.PROMPT_RULES_DYNAMIC:
+        return SYSTEM_PROMPT_V4, ""
+    try:
+        rules = await select_rules(query)
+    except Exception as e:
+        # без индекса правил безопаснее отправить все правила
+        logger.error(f"Error selecting prompt rules: {str(e)}")
+        metrics.inc("system_prompt_fallback")
+        rules = list(RULE_PATTERNS)
+
+    section = rules_section(rules)
+    logger.debug(f"Prompt rules selected: {rules}")
+    metrics.observe("system_prompt_rules", len(rules))
+    metrics.observe("system_prompt_chars", len(SYSTEM_PROMPT_CORE) + len(section))
+    return SYSTEM_PROMPT_CORE, section
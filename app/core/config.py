@@ -20,6 +20,9 @@ class Settings(BaseSettings):
     POOL_TIMEOUT:int
     MAX_OVERFLOW:int
     POOL_RECYCLE:int
+    # LangGraph turn checkpoints (psycopg conninfo, defaults to DB_URL)
+    CHECKPOINT_DB_URL:str = ""
+    TURN_CHECKPOINTS:bool = True
 
     # redis
     REDIS_PASSWORD:str
@@ -27,12 +30,78 @@ class Settings(BaseSettings):
     REDIS_USER_PASSWORD:str
     REDIS_URL:str
     BUFFER_TIMEOUT:int
+    # adaptive debounce window, seconds
+    BUFFER_TIMEOUT_MIN:int = 5
+    BUFFER_TIMEOUT_MAX:int = 120
+    BUFFER_TIMEOUT_QUESTION:int = 8
+    # chats that rarely send more than one message per turn
+    BUFFER_TIMEOUT_SINGLE:int = 20
+    BUFFER_BURST_THRESHOLD:float = 0.5
+    BUFFER_GAP_FACTOR:float = 1.5
+    BUFFER_GAP_ALPHA:float = 0.3
+    BUFFER_MAX_WORKERS:int = 8
+    BUFFER_CLAIM_IDLE:int = 330
+    # per-chat processing lock; a flush may queue for a worker up to BUFFER_QUEUE_WAIT_MAX
+    BUFFER_LOCK_TIMEOUT:int = 300
+    BUFFER_QUEUE_WAIT_MAX:int = 900
+    # failed turns are retried, then moved to the dead-letter list
+    BUFFER_MAX_ATTEMPTS:int = 3
     
     # Qdrant
     QDRANT_URL:str
     QDRANT_COLLECTION_NAME:str
     EMBEDDING_URL:str
     EMBEDDING_TOKEN:str
+    # pooled HTTP clients (embedding endpoint, OpenAI embeddings, Qdrant)
+    HTTP2:bool = True
+    HTTP_MAX_CONNECTIONS:int = 100
+    HTTP_MAX_KEEPALIVE:int = 20
+    HTTP_KEEPALIVE_EXPIRY:float = 30.0
+    HTTP_CONNECT_TIMEOUT:float = 5.0
+    HTTP_READ_TIMEOUT:float = 30.0
+    # embedding provider circuit breaker / hedging
+    EMBEDDING_BREAKER_FAILURES:int = 3
+    EMBEDDING_BREAKER_COOLDOWN:float = 30.0
+    EMBEDDING_HEDGING:bool = False
+    EMBEDDING_HEDGE_MIN_DELAY:float = 0.3
+    EMBEDDING_CACHE_SIZE:int = 2048
+    EMBEDDING_CACHE_TTL:int = 7 * 24 * 3600
+    LABEL_INDEX_TOP_K:int = 5
+    LABEL_PREFILTER:bool = True
+    LABEL_PREFILTER_TOP_N:int = 20
+    # share of labelling calls re-run against the full catalog for the label_shadow_*
+    # metrics; opt-in since each run is a second gpt-4o call: LABEL_PREFILTER_SHADOW_RATE=0.1 in .env
+    LABEL_PREFILTER_SHADOW_RATE:float = 0.0
+    PROMPT_RULES_DYNAMIC:bool = True
+    PROMPT_RULES_TOP_K:int = 3
+    PROMPT_RULES_MIN_SCORE:float = 0.45
+    PROMPT_RULES_MAX:int = 6
+    ANSWER_CACHE_ENABLED:bool = True
+    ANSWER_CACHE_COLLECTION:str = "answer_cache"
+    ANSWER_CACHE_THRESHOLD:float = 0.95
+    ANSWER_CACHE_TTL:int = 7 * 24 * 3600
+    ANSWER_CACHE_VERSION:str = "1"
+    ANSWER_CACHE_CONTEXT_HOURS:int = 24
+    # Omnidesk API quota: requests per minute and allowed burst
+    OMNIDESK_RATE_LIMIT:int = 300
+    OMNIDESK_RATE_BURST:int = 10
+    OMNIDESK_MAX_RETRIES:int = 3
+    # outbound outbox: Omnidesk deliveries retried in the background
+    OUTBOX_MAX_SENDERS:int = 8
+    OUTBOX_MAX_ATTEMPTS:int = 8
+    OUTBOX_LEASE:int = 120
+    OUTBOX_IDLE_TIMEOUT:float = 300.0
+    OUTBOX_BACKOFF_BASE:float = 1.0
+    OUTBOX_BACKOFF_MAX:float = 300.0
+    # attachments: hard size cutoff and in-memory part of the spooled file
+    ATTACHMENT_MAX_BYTES:int = 20 * 1024 * 1024
+    ATTACHMENT_SPOOL_BYTES:int = 1024 * 1024
+    # image preprocessing before vision calls
+    IMAGE_WORKERS:int = 4
+    IMAGE_FORMAT:str = "JPEG"
+    IMAGE_QUALITY:int = 85
+    IMAGE_DETAIL:str = "auto"
+    ATTACHMENT_CACHE_TTL:int = 30 * 24 * 3600
 
     class Config:
         env_file = ".env"
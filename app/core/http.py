@@ -0,0 +1,21 @@
+import httpx
+
+from app.core.config import settings
+
+
+def http_limits() -> httpx.Limits:
+    """Pool limits shared by the long-lived clients (embeddings, Qdrant, Omnidesk)"""
+    return httpx.Limits(
+        max_connections=settings.HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def http_timeout() -> httpx.Timeout:
+    return httpx.Timeout(
+        connect=settings.HTTP_CONNECT_TIMEOUT,
+        read=settings.HTTP_READ_TIMEOUT,
+        write=settings.HTTP_READ_TIMEOUT,
+        pool=settings.HTTP_CONNECT_TIMEOUT,
+    )
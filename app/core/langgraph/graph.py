@@ -1,9 +1,10 @@
-from typing import TypedDict, Union
+from typing import NotRequired, TypedDict, Union
 from langgraph.graph import StateGraph, START, END
 from langchain_openai import ChatOpenAI
 from app.core.config import settings
 from app.core.logging import logger
-from langchain_core.messages import BaseMessage
+from app.core.metrics import metrics
+from langchain_core.messages import BaseMessage, SystemMessage
 from openai import OpenAI, AsyncOpenAI
 
 
@@ -15,13 +16,51 @@ class AgentState(TypedDict):
     last_message: Union[str, BaseMessage]
     response: str
     system_message: Union[str, BaseMessage]
+    # per-turn instructions that follow the static system prompt
+    context_message: NotRequired[Union[str, BaseMessage]]
     tokens: int
+    prompt_tokens: int
+    cached_tokens: int
+
+
+def as_system(message: Union[str, BaseMessage]) -> SystemMessage:
+    if isinstance(message, SystemMessage):
+        return message
+    return SystemMessage(content=message if isinstance(message, str) else message.content)
+
+
+def build_messages(state: AgentState) -> list[BaseMessage]:
+    """
+    Static system prompt first, then per-turn instructions, then the user prompt:
+    the provider caches the longest repeated prefix, so the part shared by
+    every turn has to come first and stay byte-identical.
+    """
+    messages = [as_system(state["system_message"])]
+    if state.get("context_message"):
+        messages.append(as_system(state["context_message"]))
+    messages.append(state["last_message"])
+    return messages
+
+
+def record_prompt_cache(usage: dict) -> int:
+    """Cached vs uncached prompt tokens from the OpenAI usage block"""
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+    metrics.inc("llm_prompt_tokens", prompt_tokens)
+    metrics.inc("llm_prompt_cached_tokens", cached_tokens)
+    metrics.inc("llm_prompt_uncached_tokens", prompt_tokens - cached_tokens)
+    if prompt_tokens:
+        metrics.observe("llm_prompt_cache_ratio", cached_tokens / prompt_tokens)
+    return cached_tokens
 
 
 async def process(state: AgentState) -> AgentState:
-    response = await llm.ainvoke([state["last_message"], state["system_message"]])
+    response = await llm.ainvoke(build_messages(state))
     logger.debug(f"\nAI: {response.content}")
-    state["tokens"] = response.response_metadata["token_usage"]["total_tokens"]
+    usage = response.response_metadata["token_usage"]
+    state["tokens"] = usage["total_tokens"]
+    state["prompt_tokens"] = usage["prompt_tokens"]
+    state["cached_tokens"] = record_prompt_cache(usage)
     state["response"] = response.content
     return state
 
@@ -0,0 +1,609 @@
+import asyncio
+import json
+import random
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Optional, TypedDict
+from zoneinfo import ZoneInfo
+
+from langchain_core.messages import HumanMessage, SystemMessage
+from langgraph.graph import END, START, StateGraph
+
+from app.api.v1.chatbot import crud
+from app.api.v1.chatbot.labels import LABELS, SUCCESS_ID, SUPPORT_ID
+from app.api.v1.chatbot.postprocess import (
+    found_recent_greeting,
+    postprocess_response,
+    strip_markdown,
+)
+from app.api.v1.chatbot.prompt_rules import build_system_prompt
+from app.core.config import settings
+from app.core.langgraph.graph import client, process
+from app.core.logging import logger
+from app.core.metrics import metrics
+from app.core.omnidesk.omnidesk_api import omnidesk_api
+from app.models.answer_cache import answer_cache
+from app.models.catalog_index import format_labels, label_index
+from app.models.db_helper import db_helper
+from app.models.outbox import Outbox, outbox
+from app.models.qdrant_helper import pack_embedding, qdrant_helper, unpack_embedding
+
+
+class TurnState(TypedDict, total=False):
+    chat_id: str
+    user_id: str
+    concatenated_messages: str
+    turn_started: float
+    # context computed during the debounce window, see RedisHelper.prewarm_turn_context
+    prewarmed: Optional[dict]
+
+    retrieved_context: str
+    point_ids: list[int]
+    formatted_history: str
+    recent_greeting: bool
+    current_time: str
+    # no messages in the chat recently, so the question does not depend on context
+    standalone: bool
+
+    response: str
+    tokens: int
+    answer_cached: bool
+    sent: bool
+    saved: bool
+    need_human_help: bool
+
+
+async def retrieve(state: TurnState) -> TurnState:
+    prewarmed = state.get("prewarmed")
+    if prewarmed:
+        return {
+            "retrieved_context": prewarmed["retrieved_context"],
+            "point_ids": prewarmed["point_ids"],
+        }
+    with metrics.timer("stage_retrieve_seconds"):
+        retrieved_context, point_ids = await qdrant_helper.retrieve_context(
+            state["concatenated_messages"]
+        )
+    return {"retrieved_context": retrieved_context, "point_ids": point_ids}
+
+
+async def history(state: TurnState) -> TurnState:
+    prewarmed = state.get("prewarmed")
+    if prewarmed:
+        messages = [
+            SimpleNamespace(
+                message=item["message"],
+                response=item["response"],
+                created_at=datetime.fromisoformat(item["created_at"]),
+            )
+            for item in prewarmed["history"]
+        ]
+    else:
+        with metrics.timer("stage_history_seconds"):
+            async with db_helper.session_factory() as session:
+                try:
+                    messages = await crud.get_chat_history(
+                        session=session, chat_id=state["chat_id"]
+                    )
+                except Exception as e:
+                    logger.error(f"Error getting chat history: {str(e)}")
+                    messages = []
+
+    history_lines = []
+    for msg in messages[-10:]:
+        local_time = msg.created_at.astimezone(ZoneInfo("Asia/Almaty"))
+        history_lines.append(
+            f"User({local_time.strftime('%Y-%m-%d %H:%M:%S %z')}): {msg.message}"
+        )
+        if msg.response:
+            history_lines.append(f"Bot: {msg.response}")
+
+    current_time = datetime.now().astimezone(ZoneInfo("Asia/Almaty"))
+    context_since = current_time - timedelta(hours=settings.ANSWER_CACHE_CONTEXT_HOURS)
+    return {
+        "formatted_history": "\n".join(history_lines),
+        "recent_greeting": found_recent_greeting(messages, current_time),
+        "current_time": current_time.isoformat(),
+        "standalone": all(msg.created_at < context_since for msg in messages),
+    }
+
+
+async def answer(state: TurnState) -> TurnState:
+    if settings.ANSWER_CACHE_ENABLED and state.get("standalone"):
+        cached = await answer_cache.lookup(state["concatenated_messages"])
+        if cached:
+            return {"response": cached, "tokens": 0, "answer_cached": True}
+
+    current_time = datetime.fromisoformat(state["current_time"])
+    prompt = f"""
+        --- Chat History (last 10 messages) ---
+        {state["formatted_history"]}
+
+        --- Retrieved Context (top 5 results) ---
+        {state["retrieved_context"]}
+
+        --- User Query (current message) ---
+        User({current_time.strftime('%Y-%m-%d %H:%M:%S %z')}): {state["concatenated_messages"]}
+
+        """
+    with metrics.timer("stage_answer_seconds"):
+        system_prompt, case_rules = await build_system_prompt(state["concatenated_messages"])
+        result = await process(
+            {
+                "system_message": SystemMessage(content=system_prompt),
+                "context_message": case_rules,
+                "last_message": HumanMessage(content=prompt),
+            }
+        )
+    metrics.observe("answer_prompt_tokens", result["prompt_tokens"])
+    logger.info(
+        f"LLM responded for chat {state['chat_id']}, tokens used: {result['tokens']}, "
+        f"prompt tokens: {result['prompt_tokens']} ({result['cached_tokens']} cached), "
+        f"system prompt chars: {len(system_prompt) + len(case_rules)}"
+    )
+    return {"response": result["response"], "tokens": result["tokens"]}
+
+
+async def llm_postprocess(response: str, recent_greeting: bool) -> str:
+    """LLM greeting filter, used only when postprocess_response cannot decide"""
+    try:
+        if recent_greeting:
+            system_instr = (
+                "Ты текстовый фильтр. Удали приветствия в начале текста плюс слово 'Я AI-ассистент TrustMe.' "
+                "(например 'Здравствуйте', 'Добрый день', 'Привет' и т.п.). "
+                "Не добавляй ничего взамен. Не объясняй свои действия. "
+                "Верни только очищенный текст."
+                "Не используйте звёздочки в любом виде: никаких **жирных**, *курсива* и обрамления текста звёздочками. Для списков применяйте нумерацию «1., 2.» или тире «-» без звёздочек."
+            )
+        else:
+            system_instr = (
+                "Ты текстовый фильтр. Если в тексте нет приветствия, добавь одно короткое уместное "
+                "приветствие в начале (например 'Здравствуйте! Я AI-ассистент TrustMe.'), затем оставь текст без изменений. "
+                "Не объясняй свои действия. Верни только финальный текст."
+                "Не используйте звёздочки в любом виде: никаких **жирных**, *курсива* и обрамления текста звёздочками. Для списков применяйте нумерацию «1., 2.» или тире «-» без звёздочек."
+            )
+
+        cleaned_response = await client.chat.completions.create(
+            model="gpt-4o",
+            response_format={"type": "text"},
+            messages=[
+                {"role": "system", "content": system_instr},
+                {"role": "user", "content": response},
+            ],
+            temperature=0,
+        )
+        response = cleaned_response.choices[0].message.content
+        logger.debug(f"Cleaned response: {response}")
+    except Exception as e:
+        logger.error(f"Error cleaning response: {str(e)}")
+        response = strip_markdown(response)
+    return response
+
+
+async def post_process(state: TurnState) -> TurnState:
+    processed = postprocess_response(state["response"], state["recent_greeting"])
+    if processed is not None:
+        metrics.inc("postprocess_rules")
+        return {"response": processed}
+    metrics.inc("postprocess_llm_fallback")
+    return {"response": await llm_postprocess(state["response"], state["recent_greeting"])}
+
+
+async def send(state: TurnState) -> TurnState:
+    """Queue the reply in the outbox; delivery does not hold up the turn"""
+    try:
+        with metrics.timer("stage_send_seconds"):
+            sent = await outbox.enqueue(
+                chat_id=state["chat_id"],
+                kind="message",
+                key=Outbox.idempotency_key(state["chat_id"], "message", state["turn_started"]),
+                content=state["response"],
+                turn_started=state["turn_started"],
+            )
+        logger.info(f"message queued for chat {state['chat_id']}")
+        return {"sent": sent}
+    except Exception as e:
+        import traceback
+        logger.error(f"ERROR SEND MESSAGE {str(e)}")
+        logger.error(traceback.format_exc())
+        return {"sent": False}
+
+
+async def save(state: TurnState) -> TurnState:
+    with metrics.timer("stage_save_seconds"):
+        try:
+            # retrieve already embedded this text, so this is an embedding cache hit
+            embedding, embedding_model = await qdrant_helper.embed_query(
+                state["concatenated_messages"]
+            )
+            embedding = pack_embedding(embedding)
+        except Exception as e:
+            logger.error(f"Error embedding message for storage: {str(e)}")
+            embedding, embedding_model = None, None
+        async with db_helper.session_factory() as session:
+            try:
+                await crud.save_message(
+                    session=session,
+                    user_id=int(state["user_id"]),
+                    chat_id=state["chat_id"],
+                    last_message=state["concatenated_messages"],
+                    response=state["response"],
+                    retrieved=state["point_ids"],
+                    embedding=embedding,
+                    embedding_model=embedding_model,
+                )
+                return {"saved": True}
+            except Exception as e:
+                logger.error(f"ERROR SAVE MESSAGE {str(e)}")
+                return {"saved": False}
+
+
+async def classify_handoff(state: TurnState) -> TurnState:
+    """Ask the LLM whether a manager has to join the chat"""
+    if state.get("answer_cached"):
+        # the answer was cached only because it did not need a manager
+        return {"need_human_help": False}
+    current_time = datetime.fromisoformat(state["current_time"])
+    with metrics.timer("stage_handoff_seconds"):
+        try:
+            prompt_human_help = f"""
+                    --- История чата (последние 10 сообщений) ---
+                    {state["formatted_history"]}
+
+                    --- Запрос клиента (текущее сообщение) ---
+                    Пользователь({current_time.strftime('%Y-%m-%d %H:%M:%S %z')}): {state["concatenated_messages"]}
+
+                    Ответ на текущее сообщение от ИИ, используя RAG: {state["response"]}
+
+                    --- Классификация запроса: ---
+                    Проанализируй запрос. Верни `True`, если нужен реальный человек для ответа, и `False`, если ИИ может ответить самостоятельно, используя доступные данные или RAG.
+
+                    Важно:
+                    1. Если вопрос связан с тарифами, пакетами или стоимостью услуг — сразу возвращай `response_required: true`, даже если есть данные в RAG.
+                    2. Если запрос общий и ИИ может ответить сам — возвращай `response_required: false`.
+                    4. Если сообщение связано с системными уведомлениями (например, содержит строки "=== SYSTEM WZ ===" или "Check this message on your device") — сразу возвращай `response_required: true` (чтобы подключился человек).
+                    5. Если сообщение равно "Подождите, пожалуйста, скоро ответит специалист." — сразу возвращай `response_required: true`.
+                    6. Ответ должен быть строго в формате JSON, например:
+
+                    Формат ответа (пример):
+                    {{
+                    "response_required": true
+                    }}
+                """
+            response_human_help = await client.chat.completions.create(
+                model="gpt-4o",
+                response_format={"type": "json_object"},
+                messages=[{"role": "user", "content": prompt_human_help}],
+                temperature=0,
+            )
+            need_human_help = json.loads(response_human_help.choices[0].message.content)
+            logger.debug(f"response from llm human help : {need_human_help}")
+            return {"need_human_help": bool(need_human_help.get("response_required"))}
+        except Exception as e:
+            logger.error(f"Error llm call for human_help : {str(e)}")
+            return {"need_human_help": False}
+
+
+async def handoff(state: TurnState) -> TurnState:
+    """Call a manager; queued after the reply, so the call lands after it"""
+    if state.get("need_human_help"):
+        try:
+            await outbox.enqueue(
+                chat_id=state["chat_id"],
+                kind="call_human",
+                key=Outbox.idempotency_key(state["chat_id"], "call_human", state["turn_started"]),
+                content="ВЫЗОВ МЕНЕДЖЕРА",
+                user_id=state["user_id"],
+            )
+        except Exception as e:
+            logger.error(f"Error call human : {str(e)}")
+    return {}
+
+
+async def remember_answer(state: TurnState) -> TurnState:
+    """Keep the answer for similar questions if it was delivered and needed no manager"""
+    if (
+        settings.ANSWER_CACHE_ENABLED
+        and state.get("standalone")
+        and state.get("sent")
+        and not state.get("answer_cached")
+        and not state.get("need_human_help")
+    ):
+        await answer_cache.store(state["concatenated_messages"], state["response"])
+    return {}
+
+
+def label_prompt(messages_for_label: str, labels_str: str, catalog: str) -> str:
+    return f"""
+            Ты — классификатор чата.
+
+            Твоя задача:
+            1. Проанализировать последние 10 сообщений чата.
+            2. Определить список релевантных меток (labels) анализируя Сообщения чата и Retrieved labels со списком доступных меток.
+            3. Определить группу (group) по следующим правилам:
+            - Если клиент новый → вернуть "Success_ID".
+            - Если клиент взаимодействует меньше 2 месяцев → вернуть "Success_ID".
+            - Если клиент не новый и взаимодействует больше 2 месяцев → вернуть "Support_ID".
+
+            Важно:
+            - Ответь строго в формате **валидного JSON**.
+            - Не добавляй никаких пояснений или текста вне JSON.
+            - Используй только указанные ID меток и групп.
+
+            Сообщения чата:
+            {messages_for_label}
+
+            Retrieved labels using knowledge base:
+            {labels_str}
+
+            Список доступных меток:
+            {catalog}
+
+            Список доступных групп:
+            Success_ID = {SUCCESS_ID}
+            Support_ID = {SUPPORT_ID}
+
+            Формат ответа (пример):
+            {{
+                "labels": [id_label_1, id_label_2],
+                "group": "96756"
+            }}
+            """
+
+
+async def classify_labels(prompt: str) -> tuple[dict, int]:
+    """Returns the parsed {"labels", "group"} answer and the prompt token count"""
+    response = await client.chat.completions.create(
+        model="gpt-4o",
+        response_format={"type": "json_object"},
+        messages=[
+            {
+                "role": "system",
+                "content": "Ты помощник-классификатор. Отвечай строго в JSON формате.",
+            },
+            {"role": "user", "content": prompt},
+        ],
+        temperature=0,
+    )
+    prompt_tokens = response.usage.prompt_tokens if response.usage else 0
+    return json.loads(response.choices[0].message.content), prompt_tokens
+
+
+def record_label_shadow(
+    result: dict, full_result: dict, full_tokens: int, candidates: dict[str, str], tokens: int
+):
+    """Compare the prefiltered classification with the full-catalog one"""
+    chosen = {str(label_id) for label_id in result.get("labels", [])}
+    expected = {str(label_id) for label_id in full_result.get("labels", [])}
+    metrics.inc("label_shadow_runs")
+    if chosen == expected:
+        metrics.inc("label_shadow_exact_match")
+    if expected:
+        # доля «правильных» меток, которые вообще попали в кандидаты
+        metrics.observe("label_shadow_candidate_recall", len(expected & set(candidates)) / len(expected))
+    if chosen | expected:
+        metrics.observe("label_shadow_jaccard", len(chosen & expected) / len(chosen | expected))
+    if str(result.get("group")) == str(full_result.get("group")):
+        metrics.inc("label_shadow_group_match")
+    if full_tokens:
+        metrics.observe("label_prompt_token_reduction", 1 - tokens / full_tokens)
+    logger.info(
+        f"Label shadow: prefiltered {sorted(chosen)} ({tokens} tokens), "
+        f"full catalog {sorted(expected)} ({full_tokens} tokens)"
+    )
+
+
+async def label(state: TurnState) -> TurnState:
+    """Set labels and group once the chat reaches 10 saved messages"""
+    chat_id = state["chat_id"]
+    with metrics.timer("stage_labels_seconds"):
+        try:
+            async with db_helper.session_factory() as history_session, db_helper.session_factory() as chat_session:
+                last_ten_msg, chat = await asyncio.gather(
+                    crud.get_chat_history(session=history_session, chat_id=chat_id),
+                    crud.get_chat_by_id(session=chat_session, chat_id=chat_id),
+                )
+
+            if len(last_ten_msg) != 10 or chat is None or chat.labels_and_group:
+                return {}
+
+            messages_for_label = ""
+            labels: list[str] = []
+
+            for m in last_ten_msg:
+                messages_for_label += (
+                    f"User message:{m.message}\n Bot response:{m.response}\n"
+                )
+            query_strs = [m.message or "" for m in last_ten_msg]
+            queries, embedding_model = await qdrant_helper.fill_embeddings(
+                query_strs,
+                [unpack_embedding(m.embedding) if m.embedding else None for m in last_ten_msg],
+                [m.embedding_model for m in last_ten_msg],
+            )
+            retrieved, scored = await asyncio.gather(
+                qdrant_helper.retrieve_labels_batch(query_strs=query_strs, embeddings=queries),
+                label_index.top_k_many(
+                    queries, model=embedding_model, k=settings.LABEL_INDEX_TOP_K
+                ),
+            )
+            for retrieved_labels in retrieved:
+                labels.extend(retrieved_labels)
+            labels = list(dict.fromkeys(label for label in labels if label))
+
+            labels_str = ", ".join(labels)
+            logger.debug(f"RETRIEVED LABELS {labels_str}")
+
+            # в промпт идут только кандидаты: метки из найденных кейсов
+            # и ближайшие метки каталога, а не весь LABELS
+            candidates = (
+                label_index.candidates(scored, labels, limit=settings.LABEL_PREFILTER_TOP_N)
+                if settings.LABEL_PREFILTER
+                else {}
+            )
+            full_prompt = label_prompt(messages_for_label, labels_str, LABELS)
+            if candidates:
+                prompt = label_prompt(messages_for_label, labels_str, format_labels(candidates))
+            else:
+                prompt = full_prompt
+            metrics.observe("label_candidates", len(candidates))
+
+            shadow = bool(candidates) and random.random() < settings.LABEL_PREFILTER_SHADOW_RATE
+            if shadow:
+                # полный каталог параллельно, только для сравнения точности
+                answer, full_answer = await asyncio.gather(
+                    classify_labels(prompt), classify_labels(full_prompt), return_exceptions=True
+                )
+                if isinstance(answer, Exception):
+                    raise answer
+                result_labels_and_group, tokens = answer
+                if isinstance(full_answer, Exception):
+                    logger.error(f"Error in label shadow run: {str(full_answer)}")
+                else:
+                    record_label_shadow(result_labels_and_group, *full_answer, candidates, tokens)
+            else:
+                result_labels_and_group, tokens = await classify_labels(prompt)
+            metrics.observe("label_prompt_tokens", tokens)
+            logger.debug(
+                f"labels: {result_labels_and_group['labels']}, group {result_labels_and_group['group']}"
+            )
+
+            try:
+                await omnidesk_api.set_labels_and_group(
+                    chat_id=chat_id,
+                    labels=result_labels_and_group["labels"],
+                    group=result_labels_and_group["group"],
+                )
+            except Exception as e:
+                logger.error(f"ERROR SETTING LABELS AND GROUP {str(e)}")
+
+            try:
+                async with db_helper.session_factory() as session:
+                    await crud.set_labels_group(session=session, chat_id=chat_id)
+            except Exception as e:
+                logger.error(f"ERROR SET LABELS AND GROUP {str(e)}")
+        except Exception as e:
+            logger.error(f"Error labelling chat {chat_id}: {str(e)}")
+    return {}
+
+
+def build_turn_graph() -> StateGraph:
+    """
+    START ─┬─ retrieve ─┬─ answer ─ post_process ─┬─ send ─────────────┬─ handoff ─ remember_answer ─ END
+           └─ history ──┘                         ├─ classify_handoff ─┘
+                                                  └─ save ─ label ─ END
+    """
+    graph = StateGraph(TurnState)
+
+    graph.add_node("retrieve", retrieve)
+    graph.add_node("history", history)
+    graph.add_node("answer", answer)
+    graph.add_node("post_process", post_process)
+    graph.add_node("send", send)
+    graph.add_node("save", save)
+    graph.add_node("classify_handoff", classify_handoff)
+    graph.add_node("handoff", handoff)
+    graph.add_node("remember_answer", remember_answer)
+    graph.add_node("label", label)
+
+    graph.add_edge(START, "retrieve")
+    graph.add_edge(START, "history")
+    graph.add_edge(["retrieve", "history"], "answer")
+    graph.add_edge("answer", "post_process")
+    graph.add_edge("post_process", "send")
+    graph.add_edge("post_process", "save")
+    graph.add_edge("post_process", "classify_handoff")
+    graph.add_edge(["send", "classify_handoff"], "handoff")
+    graph.add_edge("save", "label")
+    graph.add_edge("handoff", "remember_answer")
+    graph.add_edge("remember_answer", END)
+    graph.add_edge("label", END)
+
+    return graph
+
+
+class TurnRunner:
+    """Runs chat turns through the turn graph with a Postgres checkpointer.
+
+    Every turn gets its own thread id, so a worker that retries a failed
+    turn or picks up one left unfinished by a crashed worker resumes from
+    the last completed step instead of repeating the LLM calls.
+    """
+
+    def __init__(self, checkpoint_url: str, enabled: bool = True):
+        self.checkpoint_url = checkpoint_url
+        self.enabled = enabled
+        self.graph = build_turn_graph()
+        self.pool = None
+        self.checkpointer = None
+        self.agent = self.graph.compile()
+
+    async def start(self):
+        if not self.enabled:
+            return
+        try:
+            from psycopg.rows import dict_row
+            from psycopg_pool import AsyncConnectionPool
+            from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+
+            self.pool = AsyncConnectionPool(
+                conninfo=self.checkpoint_url,
+                max_size=settings.POOL_SIZE,
+                kwargs={"autocommit": True, "prepare_threshold": 0, "row_factory": dict_row},
+                open=False,
+            )
+            await self.pool.open()
+            self.checkpointer = AsyncPostgresSaver(self.pool)
+            await self.checkpointer.setup()
+            self.agent = self.graph.compile(checkpointer=self.checkpointer)
+            logger.info("Turn graph checkpointer started")
+        except Exception as e:
+            logger.error(f"Turn graph checkpointer unavailable, running without it: {str(e)}")
+            self.checkpointer = None
+            self.agent = self.graph.compile()
+
+    async def stop(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    async def run(self, state: TurnState, thread_id: str) -> TurnState:
+        if self.checkpointer is None:
+            return await self.agent.ainvoke(state)
+
+        config = {"configurable": {"thread_id": thread_id}}
+        snapshot = await self.agent.aget_state(config)
+        if snapshot.values and (
+            snapshot.values.get("concatenated_messages") != state["concatenated_messages"]
+        ):
+            # messages arrived since the failed attempt: the turn starts over
+            logger.info(f"Turn {thread_id} has new messages, discarding its checkpoints")
+            await self.delete_thread(thread_id)
+            snapshot = await self.agent.aget_state(config)
+
+        if snapshot.next:
+            logger.info(f"Resuming turn {thread_id} at {snapshot.next}")
+            metrics.inc("turn_resumed")
+            result = await self.agent.ainvoke(None, config)
+        elif snapshot.values:
+            # finished before the worker died, only the cleanup is missing
+            logger.info(f"Turn {thread_id} already completed")
+            result = snapshot.values
+        else:
+            result = await self.agent.ainvoke(state, config)
+
+        await self.delete_thread(thread_id)
+        return result
+
+    async def delete_thread(self, thread_id: str):
+        """Drop the checkpoints of a finished or abandoned turn"""
+        if self.checkpointer is None:
+            return
+        try:
+            await self.checkpointer.adelete_thread(thread_id)
+        except Exception as e:
+            logger.error(f"Error deleting checkpoints for turn {thread_id}: {str(e)}")
+
+
+turn_runner = TurnRunner(
+    checkpoint_url=settings.CHECKPOINT_DB_URL or settings.DB_URL.replace("+asyncpg", ""),
+    enabled=settings.TURN_CHECKPOINTS,
+)
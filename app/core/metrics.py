@@ -0,0 +1,64 @@
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Dict
+
+
+class Metrics:
+    """In-process metrics registry: counters, gauges and timing samples"""
+
+    def __init__(self, max_samples: int = 1000):
+        self.max_samples = max_samples
+        self.counters: Dict[str, float] = defaultdict(float)
+        self.gauges: Dict[str, float] = {}
+        self.timings: Dict[str, deque] = defaultdict(
+            lambda: deque(maxlen=self.max_samples)
+        )
+
+    def inc(self, name: str, value: float = 1):
+        self.counters[name] += value
+
+    def set_gauge(self, name: str, value: float):
+        self.gauges[name] = value
+
+    def add_gauge(self, name: str, value: float):
+        self.gauges[name] = self.gauges.get(name, 0) + value
+
+    def observe(self, name: str, value: float):
+        self.timings[name].append(value)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def percentile(self, name: str, q: float) -> float | None:
+        samples = sorted(self.timings.get(name, ()))
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(q * (len(samples) - 1))))
+        return samples[index]
+
+    def snapshot(self) -> dict:
+        timings = {}
+        for name, samples in self.timings.items():
+            if not samples:
+                continue
+            timings[name] = {
+                "count": len(samples),
+                "avg": sum(samples) / len(samples),
+                "p50": self.percentile(name, 0.5),
+                "p95": self.percentile(name, 0.95),
+                "max": max(samples),
+            }
+        return {
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "timings": timings,
+        }
+
+
+metrics = Metrics()
@@ -1,8 +1,18 @@
+import asyncio
 import httpx
+import posixpath
 from app.core.config import settings
-import re
-import base64
+from app.core.logging import logger
+from app.core.metrics import metrics
+from app.core.resilience import TokenBucket
+from app.core.http import http_limits, http_timeout
+from tempfile import SpooledTemporaryFile
 from typing import List
+from urllib.parse import urlsplit
+
+
+class AttachmentTooLarge(Exception):
+    pass
 
 
 class OmnideskAPI:
@@ -10,58 +20,107 @@ class OmnideskAPI:
         self.OMNIDESK_DOMAIN: str = settings.OMNIDESK_DOMAIN
         self.STAFF_ID: int = settings.STAFF_ID
         self.auth = (settings.USER_EMAIL, settings.OMNIDESK_API_KEY)
+        # one pooled client for every call: keep-alive instead of a handshake per request
+        self.client = httpx.AsyncClient(
+            auth=self.auth, http2=settings.HTTP2, limits=http_limits(), timeout=http_timeout()
+        )
+        # requests queue here instead of hitting Omnidesk's quota and getting 429
+        self.limiter = TokenBucket(
+            name="omnidesk_rate_limit",
+            rate=settings.OMNIDESK_RATE_LIMIT / 60,
+            capacity=settings.OMNIDESK_RATE_BURST,
+        )
+
+    async def start(self):
+        try:
+            await self.client.head(self.OMNIDESK_DOMAIN)
+        except Exception as e:
+            logger.error(f"Warm-up of omnidesk client failed: {e}")
+
+    async def stop(self):
+        await self.client.aclose()
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Rate-limited request; a 429 pauses the limiter for Retry-After and is retried"""
+        for attempt in range(settings.OMNIDESK_MAX_RETRIES + 1):
+            await self.limiter.acquire()
+            with metrics.timer("omnidesk_request_seconds"):
+                response = await self.client.request(method, url, **kwargs)
+            if response.status_code != 429 or attempt == settings.OMNIDESK_MAX_RETRIES:
+                return response
+            metrics.inc("omnidesk_429")
+            try:
+                retry_after = float(response.headers.get("Retry-After", 1))
+            except ValueError:
+                retry_after = 1.0
+            logger.info(f"Omnidesk rate limit hit, retrying in {retry_after}s")
+            self.limiter.pause(retry_after)
+        return response
 
     async def send_message(self, content: str, chat_id: str):
         data = {"message": {"content": content, "staff_id": self.STAFF_ID}}  # сотрудник
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                auth=self.auth,
-                url=f"{self.OMNIDESK_DOMAIN}/cases/{chat_id}/messages.json",
-                json=data,
-            )
-        # response = httpx.post(auth=self.auth,url=f"{self.OMNIDESK_DOMAIN}/cases/{chat_id}/messages.json",json=data)
-
+        response = await self.request(
+            "POST", f"{self.OMNIDESK_DOMAIN}/cases/{chat_id}/messages.json", json=data
+        )
         return response.status_code
 
-    async def download_image(self, last_message: str):
-        urls = re.findall(r"https?://\S+", last_message)
-        for url in urls:
-            async with httpx.AsyncClient() as client:
-                result = await client.get(auth=self.auth, url=url)
-            # result = httpx.get(auth=self.auth,url=url)
-        image_data = base64.b64encode(result.content).decode(encoding="utf-8")
-        return image_data
+    async def download_attachment(self, url: str) -> SpooledTemporaryFile:
+        """Stream one attachment into a spooled temp file: memory first, disk past ATTACHMENT_SPOOL_BYTES"""
+        file = SpooledTemporaryFile(max_size=settings.ATTACHMENT_SPOOL_BYTES)
+        try:
+            await self.limiter.acquire()
+            with metrics.timer("attachment_download_seconds"):
+                async with self.client.stream("GET", url) as response:
+                    response.raise_for_status()
+                    declared = int(response.headers.get("Content-Length") or 0)
+                    if declared > settings.ATTACHMENT_MAX_BYTES:
+                        raise AttachmentTooLarge(f"{url} is {declared} bytes")
+                    size = 0
+                    async for chunk in response.aiter_bytes():
+                        size += len(chunk)
+                        if size > settings.ATTACHMENT_MAX_BYTES:
+                            raise AttachmentTooLarge(f"{url} is over {settings.ATTACHMENT_MAX_BYTES} bytes")
+                        file.write(chunk)
+            file.seek(0)
+            metrics.observe("attachment_bytes", size)
+            return file
+        except BaseException:
+            file.close()
+            raise
 
-    async def download_audio(self, last_message: str):
-        urls = re.findall(r"https?://\S+", last_message)
-        for url in urls:
-            async with httpx.AsyncClient() as client:
-                result = await client.get(auth=self.auth, url=url)
-            # result = httpx.get(auth=self.auth,url=url)
-        # audio_data = base64.b64encode(result.content).decode(encoding="utf-8")
-        # return audio_data
-        return result.content
+    async def download_attachments(self, urls: List[str]) -> List[tuple[str, SpooledTemporaryFile]]:
+        """
+        Download all attachments concurrently as (file name, file) pairs.
+        Attachments that fail or are too large are skipped; the caller closes the files.
+        """
+        results = await asyncio.gather(
+            *(self.download_attachment(url) for url in urls), return_exceptions=True
+        )
+        attachments = []
+        for url, result in zip(urls, results):
+            if isinstance(result, AttachmentTooLarge):
+                metrics.inc("attachment_too_large")
+                logger.error(f"Attachment skipped: {result}")
+            elif isinstance(result, Exception):
+                metrics.inc("attachment_errors")
+                logger.error(f"Error downloading attachment {url}: {str(result)}")
+            else:
+                attachments.append((posixpath.basename(urlsplit(url).path), result))
+        return attachments
 
     async def set_labels_and_group(self, chat_id: str, labels: List[int], group: str):
         data = {"case": {"group_id": group, "add_labels": labels}}
-
-        async with httpx.AsyncClient() as client:
-            result = await client.put(
-                auth=self.auth,
-                url=f"{self.OMNIDESK_DOMAIN}/cases/{chat_id}.json",
-                json=data,
-            )
+        result = await self.request(
+            "PUT", f"{self.OMNIDESK_DOMAIN}/cases/{chat_id}.json", json=data
+        )
         return result.status_code
 
     async def call_human(self, chat_id: str, user_id: int, message: str = "ВЫЗОВ МЕНЕДЖЕРА"):
         data = {"message": {"content": message, "user_id": user_id}}
-        async with httpx.AsyncClient() as client:
-            result = await client.post(
-                auth=self.auth,
-                url=f"{self.OMNIDESK_DOMAIN}/cases/{chat_id}/messages.json",
-                json=data,
-            )
-            return result.status_code
+        result = await self.request(
+            "POST", f"{self.OMNIDESK_DOMAIN}/cases/{chat_id}/messages.json", json=data
+        )
+        return result.status_code
 
 
 omnidesk_api = OmnideskAPI()
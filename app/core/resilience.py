@@ -0,0 +1,114 @@
+import asyncio
+import time
+
+from app.core.logging import logger
+from app.core.metrics import metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+_STATE_GAUGE = {CLOSED: 0, HALF_OPEN: 0.5, OPEN: 1}
+
+
+class CircuitBreaker:
+    """Remembers provider health and skips a failing provider for a cooldown.
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    ``allow()`` returns False for ``cooldown`` seconds. Then a single probe
+    call is let through (half-open): success closes the breaker, failure
+    opens it for another cooldown.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 3, cooldown: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self._publish()
+
+    def _publish(self):
+        metrics.set_gauge(f"breaker_{self.name}_state", _STATE_GAUGE[self.state])
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            logger.info(f"Circuit breaker {self.name}: {self.state} -> {state}")
+            self.state = state
+            self._publish()
+
+    def allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+            self._set_state(HALF_OPEN)
+        if self.state == HALF_OPEN and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return True
+        metrics.inc(f"breaker_{self.name}_rejected")
+        return False
+
+    def would_allow(self) -> bool:
+        """What allow() would answer now, without taking the half-open probe"""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return time.monotonic() - self.opened_at >= self.cooldown
+        return not self.probe_in_flight
+
+    def record_success(self):
+        self.failures = 0
+        self.probe_in_flight = False
+        self._set_state(CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        self.probe_in_flight = False
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._set_state(OPEN)
+
+    def record_cancelled(self):
+        """A call abandoned by the caller (e.g. a lost hedge) says nothing about health"""
+        self.probe_in_flight = False
+
+
+class TokenBucket:
+    """Client-side rate limiter: ``acquire()`` waits for a token instead of failing.
+
+    Tokens refill at ``rate`` per second up to ``capacity`` (the allowed burst).
+    Waiters are served in arrival order. ``pause()`` empties the bucket for a
+    while, e.g. after the server answered 429 with Retry-After.
+    """
+
+    def __init__(self, name: str, rate: float, capacity: int):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        started = time.monotonic()
+        async with self.lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+        waited = time.monotonic() - started
+        metrics.observe(f"{self.name}_wait_seconds", waited)
+        if waited > 0.01:
+            metrics.inc(f"{self.name}_throttled")
+
+    def pause(self, seconds: float):
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
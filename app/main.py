@@ -3,15 +3,33 @@ from app.api.v1.api import api_router
 from app.core.config import settings
 from contextlib import asynccontextmanager
 from app.models.redis_helper import redis_helper
+from app.core.langgraph.turn_graph import turn_runner
+from app.models.qdrant_helper import qdrant_helper
+from app.models.catalog_index import label_index
+from app.api.v1.chatbot.prompt_rules import rule_index
+from app.models.answer_cache import answer_cache
+from app.core.omnidesk.omnidesk_api import omnidesk_api
+from app.models.outbox import outbox
 
 
 @asynccontextmanager
 async def lifespan(app:FastAPI):
+    await qdrant_helper.start()
+    await omnidesk_api.start()
+    await label_index.start()
+    await rule_index.start()
+    await answer_cache.start()
+    await turn_runner.start()
+    await outbox.start()
     await redis_helper.start()
     print("REDIS HELPER STARTED")
     yield
     await redis_helper.stop()
     print("REDIS HELPER STOPPED")
+    await turn_runner.stop()
+    await outbox.stop()
+    await omnidesk_api.stop()
+    await qdrant_helper.stop()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -0,0 +1,219 @@
+import hashlib
+import re
+import time
+import uuid
+from typing import Optional
+
+from qdrant_client import models
+
+from app.api.v1.chatbot.labels import SYSTEM_PROMPT_V4
+from app.core.config import settings
+from app.core.langgraph.graph import llm
+from app.core.logging import logger
+from app.core.metrics import metrics
+from app.models.qdrant_helper import EmbeddingCache, qdrant_helper
+
+# признаки того, что вопрос или ответ относится к конкретному клиенту
+PERSONAL_PATTERNS = {
+    "email": re.compile(r"[\w.+-]+@[\w-]+\.[\w.]+"),
+    "link": re.compile(r"https?://|www\.|\b[\w-]+\.(?:kz|ru|com|org|net|io|me)\b", re.IGNORECASE),
+    # БИН/ИИН, телефоны, номера договоров и заявок
+    "number": re.compile(r"\d[\d\s()-]{6,}\d"),
+    # обращение по имени: "Добрый день, Айгерим!"
+    "name": re.compile(
+        r"\b(?i:здравствуйте|добрый\s+(?:день|вечер)|доброе\s+утро|привет|сәлеметсіз\s*бе|қайырлы\s+күн|hello|hi)"
+        r",\s*[A-ZА-ЯЁӘҒҚҢӨҰҮҺІ][\w-]+"
+    ),
+}
+
+
+def personal_content(*texts: str) -> str | None:
+    """Name of the first chat-specific pattern found in the texts, or None"""
+    for name, pattern in PERSONAL_PATTERNS.items():
+        if any(pattern.search(text or "") for text in texts):
+            return name
+    return None
+
+
+def prompt_version() -> str:
+    """Answers are only reused under the prompt and model that produced them"""
+    source = f"{settings.ANSWER_CACHE_VERSION}:{llm.model_name}:{SYSTEM_PROMPT_V4}"
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()[:16]
+
+
+class AnswerCache:
+    """
+    Semantic cache of vetted bot answers in a dedicated Qdrant collection.
+
+    A point is the embedding of a standalone user question with the answer
+    in its payload. A later question above ``threshold`` similarity, under
+    the same prompt version and embedding model and younger than ``ttl``,
+    gets the stored answer instead of an LLM call. Expired points are never
+    matched; they and the points of older prompt versions are deleted on
+    startup. Only answers without chat-specific content (names, BIN/IIN and
+    other numbers, links, e-mails) are stored, see ``personal_content``.
+    """
+
+    def __init__(self, collection_name: str, threshold: float, ttl: int, recheck_interval: float = 60):
+        self.collection_name = collection_name
+        self.threshold = threshold
+        self.ttl = ttl
+        self.version = prompt_version()
+        self.collection_ready = False
+        # another replica may create the collection after this one started
+        self.recheck_interval = recheck_interval
+        self.checked_at = 0.0
+
+    @property
+    def client(self):
+        return qdrant_helper.qdrant_client
+
+    def current_filter(self, embedding_model: str) -> models.Filter:
+        return models.Filter(
+            must=[
+                models.FieldCondition(
+                    key="prompt_version", match=models.MatchValue(value=self.version)
+                ),
+                models.FieldCondition(
+                    key="embedding_model", match=models.MatchValue(value=embedding_model)
+                ),
+                models.FieldCondition(
+                    key="created_at", range=models.Range(gte=time.time() - self.ttl)
+                ),
+            ]
+        )
+
+    async def start(self):
+        try:
+            if await self.check_collection():
+                await self.purge()
+        except Exception as e:
+            logger.error(f"Error starting answer cache: {str(e)}")
+
+    async def check_collection(self) -> bool:
+        """Whether the collection exists; asks Qdrant at most every ``recheck_interval``"""
+        if self.collection_ready:
+            return True
+        if time.monotonic() - self.checked_at < self.recheck_interval:
+            return False
+        self.checked_at = time.monotonic()
+        self.collection_ready = await self.client.collection_exists(self.collection_name)
+        return self.collection_ready
+
+    async def purge(self):
+        """Drop answers of other prompt versions and expired ones"""
+        await self.client.delete(
+            collection_name=self.collection_name,
+            points_selector=models.FilterSelector(
+                filter=models.Filter(
+                    should=[
+                        models.Filter(
+                            must_not=[
+                                models.FieldCondition(
+                                    key="prompt_version",
+                                    match=models.MatchValue(value=self.version),
+                                )
+                            ]
+                        ),
+                        models.FieldCondition(
+                            key="created_at", range=models.Range(lt=time.time() - self.ttl)
+                        ),
+                    ]
+                )
+            ),
+        )
+
+    async def ensure_collection(self, size: int):
+        if self.collection_ready:
+            return
+        if not await self.client.collection_exists(self.collection_name):
+            await self.client.create_collection(
+                collection_name=self.collection_name,
+                vectors_config=models.VectorParams(size=size, distance=models.Distance.COSINE),
+            )
+            await self.client.create_payload_index(
+                collection_name=self.collection_name,
+                field_name="prompt_version",
+                field_schema=models.PayloadSchemaType.KEYWORD,
+            )
+            await self.client.create_payload_index(
+                collection_name=self.collection_name,
+                field_name="embedding_model",
+                field_schema=models.PayloadSchemaType.KEYWORD,
+            )
+            await self.client.create_payload_index(
+                collection_name=self.collection_name,
+                field_name="created_at",
+                field_schema=models.PayloadSchemaType.FLOAT,
+            )
+            logger.info(f"Created answer cache collection {self.collection_name}")
+        self.collection_ready = True
+
+    async def lookup(self, query: str) -> Optional[str]:
+        """Stored answer for a question similar enough to ``query``, or None"""
+        try:
+            if not await self.check_collection():
+                return None
+            metrics.inc("answer_cache_lookups")
+            with metrics.timer("answer_cache_lookup_seconds"):
+                embedding, embedding_model = await qdrant_helper.embed_query(query_str=query)
+                result = await self.client.query_points(
+                    collection_name=self.collection_name,
+                    query=embedding,
+                    query_filter=self.current_filter(embedding_model),
+                    score_threshold=self.threshold,
+                    with_payload=True,
+                    limit=1,
+                )
+        except Exception as e:
+            logger.error(f"Error looking up answer cache: {str(e)}")
+            return None
+        if not result.points:
+            return None
+        point = result.points[0]
+        metrics.inc("answer_cache_hits")
+        metrics.observe("answer_cache_hit_score", point.score)
+        logger.info(f"Answer cache hit {point.id} (score {point.score:.3f})")
+        return point.payload.get("answer")
+
+    async def store(self, query: str, answer: str):
+        reason = personal_content(query, answer)
+        if reason is not None:
+            # served to another customer, this would leak the chat's details
+            metrics.inc("answer_cache_rejected")
+            logger.debug(f"Answer not cached, chat-specific content: {reason}")
+            return
+        try:
+            embedding, embedding_model = await qdrant_helper.embed_query(query_str=query)
+            await self.ensure_collection(len(embedding))
+            # the same question under the same prompt version and model overwrites its answer
+            point_id = uuid.uuid5(
+                uuid.NAMESPACE_URL,
+                f"{self.version}:{embedding_model}:{EmbeddingCache.normalize(query)}",
+            )
+            await self.client.upsert(
+                collection_name=self.collection_name,
+                points=[
+                    models.PointStruct(
+                        id=str(point_id),
+                        vector=embedding,
+                        payload={
+                            "query": query,
+                            "answer": answer,
+                            "prompt_version": self.version,
+                            "embedding_model": embedding_model,
+                            "created_at": time.time(),
+                        },
+                    )
+                ],
+            )
+            metrics.inc("answer_cache_stores")
+        except Exception as e:
+            logger.error(f"Error storing answer in cache: {str(e)}")
+
+
+answer_cache = AnswerCache(
+    collection_name=settings.ANSWER_CACHE_COLLECTION,
+    threshold=settings.ANSWER_CACHE_THRESHOLD,
+    ttl=settings.ANSWER_CACHE_TTL,
+)
@@ -0,0 +1,187 @@
+import asyncio
+import hashlib
+import json
+from typing import Callable, Optional
+
+import numpy as np
+
+from app.api.v1.chatbot.labels import LABELS
+from app.core.logging import logger
+from app.core.metrics import metrics
+from app.models.qdrant_helper import JINA_MODEL, qdrant_helper
+
+
+def parse_labels(catalog: str) -> dict[str, str]:
+    """LABELS is a list of `"id": "title",` lines - parse it into {id: title}"""
+    return json.loads("{" + catalog.strip().rstrip(",") + "}")
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    """Inverse of parse_labels, in the LABELS layout"""
+    return ",\n".join(
+        f"{json.dumps(label_id)}: {json.dumps(title, ensure_ascii=False)}"
+        for label_id, title in labels.items()
+    )
+
+
+class CatalogIndex:
+    """
+    A text catalog (labels, prompt rules) held in memory as a normalised
+    embedding matrix.
+
+    ``parse`` turns the catalog text into {id: text to embed}. Candidates for
+    a query are the top-k rows by cosine similarity - one matrix product, no
+    Qdrant round trip. The catalog is parsed and embedded once; the index is
+    rebuilt when the catalog text changes. Embeddings go through
+    qdrant_helper.embed_many_with_model, so a restart reads them back from
+    the embedding cache.
+
+    The matrix remembers its embedding model. A query from another model
+    gets no matches; if the index was built by the fallback provider, the
+    first query of the primary model triggers a rebuild with it.
+    """
+
+    def __init__(
+        self,
+        catalog: str = LABELS,
+        parse: Callable[[str], dict[str, str]] = parse_labels,
+        name: str = "label_index",
+    ):
+        self.catalog = catalog
+        self.parse = parse
+        self.name = name
+        self.fingerprint: Optional[str] = None
+        self.label_ids: list[str] = []
+        self.titles: list[str] = []
+        self.matrix: Optional[np.ndarray] = None
+        self.model: Optional[str] = None
+        self.lock = asyncio.Lock()
+        self.rebuild_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def catalog_fingerprint(catalog: str) -> str:
+        return hashlib.sha256(catalog.encode("utf-8")).hexdigest()
+
+    @property
+    def ready(self) -> bool:
+        return self.matrix is not None and self.fingerprint == self.catalog_fingerprint(self.catalog)
+
+    async def build(self, catalog: Optional[str] = None, model: Optional[str] = None):
+        """(Re)build the index; a no-op if neither the catalog nor the wanted model changed"""
+        if catalog is not None:
+            self.catalog = catalog
+        async with self.lock:
+            fingerprint = self.catalog_fingerprint(self.catalog)
+            if (
+                self.matrix is not None
+                and fingerprint == self.fingerprint
+                and (model is None or model == self.model)
+            ):
+                return
+            with metrics.timer(f"{self.name}_build_seconds"):
+                labels = self.parse(self.catalog)
+                embeddings, embedding_model = await qdrant_helper.embed_many_with_model(
+                    list(labels.values())
+                )
+                matrix = np.asarray(embeddings, dtype=np.float32)
+                norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+                matrix /= np.where(norms == 0, 1, norms)
+
+            self.label_ids = list(labels.keys())
+            self.titles = list(labels.values())
+            self.matrix = matrix
+            self.model = embedding_model
+            self.fingerprint = fingerprint
+            metrics.set_gauge(f"{self.name}_size", len(self.label_ids))
+            logger.info(
+                f"{self.name} built: {len(self.label_ids)} entries, "
+                f"model {embedding_model}, dim {matrix.shape[1]}"
+            )
+
+    async def start(self):
+        try:
+            await self.build()
+        except Exception as e:
+            # the index is built lazily on the first lookup instead
+            logger.error(f"Error building {self.name}: {str(e)}")
+
+    def schedule_rebuild(self, model: str):
+        if self.rebuild_task is not None and not self.rebuild_task.done():
+            return
+
+        async def rebuild():
+            try:
+                await self.build(model=model)
+            except Exception as e:
+                logger.error(f"Error rebuilding {self.name}: {str(e)}")
+
+        self.rebuild_task = asyncio.create_task(rebuild())
+
+    async def top_k_many(
+        self, queries: list[list[float]], model: str, k: int = 5
+    ) -> list[list[tuple[str, str, float]]]:
+        """Top-k (id, text, cosine similarity) for every query vector embedded by ``model``"""
+        if not queries:
+            return []
+        if not self.ready:
+            await self.build()
+
+        if model != self.model:
+            # a different vector space: the dimensions may match, the scores would not
+            metrics.inc(f"{self.name}_model_mismatch")
+            logger.error(f"{self.name} is built with {self.model}, query is {model}")
+            if model == JINA_MODEL:
+                self.schedule_rebuild(model)
+            return [[] for _ in queries]
+
+        with metrics.timer(f"{self.name}_query_seconds"):
+            query_matrix = np.asarray(queries, dtype=np.float32)
+            norms = np.linalg.norm(query_matrix, axis=1, keepdims=True)
+            scores = (query_matrix / np.where(norms == 0, 1, norms)) @ self.matrix.T
+
+            k = min(k, scores.shape[1])
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            results = []
+            for row, candidates in zip(scores, top):
+                ranked = candidates[np.argsort(-row[candidates])]
+                results.append(
+                    [(self.label_ids[i], self.titles[i], float(row[i])) for i in ranked]
+                )
+        return results
+
+    def title_to_id(self) -> dict[str, str]:
+        return {title: label_id for label_id, title in zip(self.label_ids, self.titles)}
+
+    def candidates(
+        self,
+        scored: list[list[tuple[str, str, float]]],
+        retrieved_titles: list[str],
+        limit: int,
+    ) -> dict[str, str]:
+        """
+        Merge index matches and retrieval hits into at most ``limit`` labels.
+
+        Labels seen in retrieved cases come first (most hits first), then the
+        best index matches by their highest similarity to any message.
+        """
+        by_title = self.title_to_id()
+        hits: dict[str, int] = {}
+        for title in retrieved_titles:
+            label_id = by_title.get(title)
+            if label_id is not None:
+                hits[label_id] = hits.get(label_id, 0) + 1
+        best: dict[str, float] = {}
+        for matches in scored:
+            for label_id, _, score in matches:
+                best[label_id] = max(score, best.get(label_id, -1.0))
+
+        ranked = sorted(hits, key=lambda label_id: (-hits[label_id], -best.get(label_id, -1.0)))
+        ranked += sorted((i for i in best if i not in hits), key=lambda label_id: -best[label_id])
+        titles = dict(zip(self.label_ids, self.titles))
+        return {label_id: titles[label_id] for label_id in ranked[:limit]}
+
+    async def top_k(self, query: list[float], model: str, k: int = 5) -> list[tuple[str, str, float]]:
+        return (await self.top_k_many([query], model=model, k=k))[0]
+
+
+label_index = CatalogIndex()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, ForeignKey, Text, DateTime, Boolean, ARRAY
+from sqlalchemy import Column, String, ForeignKey, Text, DateTime, Boolean, ARRAY, LargeBinary
 from sqlalchemy.dialects.postgresql import BIGINT, INTEGER
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
@@ -37,6 +37,10 @@ class Message(Base):
     message = Column(Text, nullable=True)
     response = Column(Text, nullable=True)
     retrieved = Column(ARRAY(INTEGER), nullable=True)
+    # float32 embedding of `message`, see qdrant_helper.pack_embedding
+    embedding = Column(LargeBinary, nullable=True)
+    # model that produced `embedding`; vectors of another model are not comparable
+    embedding_model = Column(String, nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     chat = relationship("Chat", back_populates="messages")
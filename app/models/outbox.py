@@ -0,0 +1,260 @@
+import asyncio
+import hashlib
+import json
+import random
+import time
+from typing import Dict, Optional
+
+import redis.asyncio as redis
+
+from app.core.config import settings
+from app.core.logging import logger
+from app.core.metrics import metrics
+from app.core.omnidesk.omnidesk_api import omnidesk_api
+from app.models.redis_scripts import OUTBOX_CLAIM, OUTBOX_ENQUEUE, OUTBOX_RELEASE, OUTBOX_RENEW
+
+
+class Outbox:
+    """
+    Durable queue of outbound Omnidesk actions (bot replies, manager calls).
+
+    The turn only writes the action to Redis; a sender loop delivers it.
+    Every chat has its own FIFO list, so a manager call never overtakes the
+    reply it follows, while different chats are delivered in parallel.
+    Failed deliveries are retried with exponential backoff and jitter; after
+    ``max_attempts`` (or a non-retryable 4xx) the entry goes to a dead-letter
+    list. An idempotency key per action makes re-queuing it a no-op, e.g. when
+    a resumed turn runs its send step again.
+
+    A sender holds a lease on the chat and renews it every third of
+    ``lease_seconds`` while delivering, so a slow delivery (rate limiter
+    queue, retries after 429) is not picked up and sent again by another
+    replica. With nothing due the sender sleeps until the earliest scheduled
+    chat instead of polling.
+    """
+
+    def __init__(
+        self,
+        redis_url: str,
+        max_senders: int = 8,
+        max_attempts: int = 8,
+        lease_seconds: int = 120,
+    ):
+        self.redis_client = redis.from_url(redis_url, decode_responses=True)
+        self.max_senders = max_senders
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.shutdown = False
+        self.sender_task: Optional[asyncio.Task] = None
+        self.chat_tasks: Dict[str, asyncio.Task] = {}
+        self.wakeup = asyncio.Event()
+
+        self.enqueue_entry = self.redis_client.register_script(OUTBOX_ENQUEUE)
+        self.claim_chats = self.redis_client.register_script(OUTBOX_CLAIM)
+        self.release_chat = self.redis_client.register_script(OUTBOX_RELEASE)
+        self.renew_lease = self.redis_client.register_script(OUTBOX_RENEW)
+
+        # redis key patterns
+        self.OUTBOX_KEY = "outbox:{chat_id}"
+        # sorted set: member = chat_id, score = when its outbox is due (or its lease ends)
+        self.DUE_KEY = "outbox_due"
+        self.DEAD_KEY = "outbox_dead"
+        self.SEEN_KEY = "outbox_seen:{key}"
+        self.SEEN_TTL = 24 * 3600
+        self.DEAD_MAXLEN = 1000
+
+    async def start(self):
+        if self.sender_task is None or self.sender_task.done():
+            self.sender_task = asyncio.create_task(self.sender_loop())
+            logger.info("Outbox sender started")
+
+    async def stop(self):
+        self.shutdown = True
+        if self.sender_task and not self.sender_task.done():
+            self.sender_task.cancel()
+        # unfinished entries stay in Redis and are sent once their lease ends
+        for task in list(self.chat_tasks.values()):
+            task.cancel()
+        await self.redis_client.aclose()
+        logger.info("Outbox sender stopped")
+
+    @staticmethod
+    def idempotency_key(chat_id: str, kind: str, turn_id) -> str:
+        return hashlib.sha256(f"{chat_id}:{kind}:{turn_id}".encode("utf-8")).hexdigest()
+
+    async def enqueue(
+        self,
+        chat_id: str,
+        kind: str,
+        key: str,
+        content: str,
+        user_id: Optional[str] = None,
+        turn_started: Optional[float] = None,
+    ) -> bool:
+        """Queue a "message" or "call_human" action; falls back to a direct call if Redis is down"""
+        entry = {
+            "id": key,
+            "kind": kind,
+            "chat_id": chat_id,
+            "user_id": user_id,
+            "content": content,
+            "turn_started": turn_started,
+            "queued_at": time.time(),
+            "attempts": 0,
+        }
+        try:
+            queued = await self.enqueue_entry(
+                keys=[
+                    self.OUTBOX_KEY.format(chat_id=chat_id),
+                    self.DUE_KEY,
+                    self.SEEN_KEY.format(key=key),
+                ],
+                args=[chat_id, json.dumps(entry, ensure_ascii=False), self.SEEN_TTL],
+            )
+        except Exception as e:
+            logger.error(f"Error queueing {kind} for chat {chat_id}, sending directly: {str(e)}")
+            metrics.inc("outbox_direct_sends")
+            status = await self.deliver(entry)
+            return 200 <= status < 300
+
+        if queued:
+            metrics.inc("outbox_enqueued")
+            self.wakeup.set()
+        else:
+            logger.info(f"Outbox {kind} for chat {chat_id} already queued, skipping")
+            metrics.inc("outbox_duplicates")
+        return True
+
+    async def sender_loop(self):
+        """Lease due chats and deliver each chat's outbox in its own task"""
+        while not self.shutdown:
+            try:
+                self.wakeup.clear()
+                free = self.max_senders - len(self.chat_tasks)
+                chat_ids, delay = [], settings.OUTBOX_IDLE_TIMEOUT
+                if free > 0:
+                    chat_ids, now, next_due = await self.claim_chats(
+                        keys=[self.DUE_KEY], args=[free, self.lease_seconds]
+                    )
+                    if next_due is not None:
+                        delay = min(delay, max(0.0, float(next_due) - float(now)))
+                for chat_id in chat_ids:
+                    if chat_id in self.chat_tasks:
+                        continue
+                    task = asyncio.create_task(self.deliver_chat(chat_id))
+                    self.chat_tasks[chat_id] = task
+                    task.add_done_callback(lambda t, c=chat_id: self.chat_task_done(c))
+                metrics.set_gauge("outbox_senders_busy", len(self.chat_tasks))
+
+                if not chat_ids:
+                    # woken early by a local enqueue or a finished chat
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Error in outbox sender: {str(e)}")
+                await asyncio.sleep(1)
+
+    async def hold_lease(self, chat_id: str):
+        """Keep renewing the chat's lease until cancelled"""
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await self.renew_lease(keys=[self.DUE_KEY], args=[chat_id, self.lease_seconds])
+            except Exception as e:
+                logger.error(f"Error renewing outbox lease of chat {chat_id}: {str(e)}")
+
+    def chat_task_done(self, chat_id: str):
+        self.chat_tasks.pop(chat_id, None)
+        self.wakeup.set()
+
+    async def deliver(self, entry: dict) -> int:
+        if entry["kind"] == "call_human":
+            return await omnidesk_api.call_human(
+                chat_id=entry["chat_id"], user_id=entry["user_id"], message=entry["content"]
+            )
+        return await omnidesk_api.send_message(content=entry["content"], chat_id=entry["chat_id"])
+
+    @staticmethod
+    def backoff(attempts: int) -> float:
+        """Exponential backoff with equal jitter"""
+        delay = min(settings.OUTBOX_BACKOFF_MAX, settings.OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def deliver_chat(self, chat_id: str):
+        """Send the chat's outbox head first; stop at the first entry that has to wait"""
+        key = self.OUTBOX_KEY.format(chat_id=chat_id)
+        delay = 0.0
+        lease = asyncio.create_task(self.hold_lease(chat_id))
+        try:
+            while not self.shutdown:
+                raw = await self.redis_client.lindex(key, 0)
+                if raw is None:
+                    break
+                entry = json.loads(raw)
+
+                permanent = False
+                try:
+                    with metrics.timer("outbox_delivery_seconds"):
+                        status = await self.deliver(entry)
+                    error = None if 200 <= status < 300 else f"HTTP {status}"
+                    permanent = 400 <= status < 500 and status not in (408, 429)
+                except Exception as e:
+                    error = str(e)
+
+                if error is None:
+                    await self.redis_client.lpop(key)
+                    metrics.inc("outbox_delivered")
+                    metrics.observe("outbox_queue_seconds", time.time() - entry["queued_at"])
+                    if entry["kind"] == "message" and entry.get("turn_started"):
+                        metrics.observe("turn_time_to_send_seconds", time.time() - entry["turn_started"])
+                    logger.info(f"Outbox {entry['kind']} delivered to chat {chat_id}")
+                    continue
+
+                entry["attempts"] += 1
+                entry["last_error"] = error
+                if permanent or entry["attempts"] >= self.max_attempts:
+                    async with self.redis_client.pipeline(transaction=True) as pipe:
+                        pipe.lpop(key)
+                        pipe.lpush(self.DEAD_KEY, json.dumps(entry, ensure_ascii=False))
+                        pipe.ltrim(self.DEAD_KEY, 0, self.DEAD_MAXLEN - 1)
+                        await pipe.execute()
+                    metrics.inc("outbox_dead_letters")
+                    logger.error(
+                        f"Outbox {entry['kind']} for chat {chat_id} dead-lettered after "
+                        f"{entry['attempts']} attempts: {error}"
+                    )
+                    continue
+
+                await self.redis_client.lset(key, 0, json.dumps(entry, ensure_ascii=False))
+                delay = self.backoff(entry["attempts"])
+                metrics.inc("outbox_retries")
+                logger.error(
+                    f"Outbox {entry['kind']} for chat {chat_id} failed ({error}), "
+                    f"retry {entry['attempts']} in {delay:.1f}s"
+                )
+                break
+        except Exception as e:
+            logger.error(f"Error delivering outbox of chat {chat_id}: {str(e)}")
+            delay = settings.OUTBOX_BACKOFF_BASE
+        finally:
+            lease.cancel()
+            await asyncio.gather(lease, return_exceptions=True)
+            try:
+                await self.release_chat(
+                    keys=[key, self.DUE_KEY], args=[chat_id, delay]
+                )
+            except Exception as e:
+                # the lease runs out and the chat becomes due again
+                logger.error(f"Error releasing outbox of chat {chat_id}: {str(e)}")
+
+
+outbox = Outbox(
+    redis_url=settings.REDIS_URL,
+    max_senders=settings.OUTBOX_MAX_SENDERS,
+    max_attempts=settings.OUTBOX_MAX_ATTEMPTS,
+    lease_seconds=settings.OUTBOX_LEASE,
+)
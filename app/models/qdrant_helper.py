@@ -1,45 +1,314 @@
-from qdrant_client import AsyncQdrantClient
+from qdrant_client import AsyncQdrantClient, models
 from openai import AsyncOpenAI
+import redis.asyncio as redis
 from app.core.config import settings
+from app.core.http import http_limits, http_timeout
+from app.core.metrics import metrics
+from app.core.resilience import CircuitBreaker
 import httpx
+import asyncio
+import hashlib
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
 from app.core.logging import logger
 
+JINA_MODEL = "text-1024"
+OPENAI_MODEL = "text-embedding-3-small"
+
+
+def pack_embedding(embedding: list[float]) -> bytes:
+    """float32 bytes, 4 KB for a 1024-dim vector"""
+    return array("f", embedding).tobytes()
+
+
+def unpack_embedding(raw: bytes) -> list[float]:
+    return array("f", raw).tolist()
+
+
+class EmbeddingCache:
+    """Two-tier embedding cache: in-process LRU in front of Redis.
+
+    Keys are the normalized text plus the model that produced the vector,
+    Redis values are compact float32 bytes with a TTL.
+    """
+
+    def __init__(self, redis_url: str, max_size: int = 2048, ttl: int = 7 * 24 * 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.local: OrderedDict[str, list[float]] = OrderedDict()
+        self.redis_client = redis.from_url(redis_url)
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(unicodedata.normalize("NFC", text).split()).casefold()
+
+    def key(self, text: str, model: str) -> str:
+        digest = hashlib.sha256(self.normalize(text).encode("utf-8")).hexdigest()
+        return f"emb:{model}:{digest}"
+
+    def remember(self, key: str, embedding: list[float]):
+        self.local[key] = embedding
+        self.local.move_to_end(key)
+        while len(self.local) > self.max_size:
+            self.local.popitem(last=False)
+
+    async def get_many(self, texts: list[str], model: str) -> list[list[float] | None]:
+        """Look up several texts under one model; one MGET for all local misses.
+
+        Only ``model`` is looked up: a vector cached by the other provider
+        lives in a different vector space.
+        """
+        keys = [self.key(text, model) for text in texts]
+        results: list[list[float] | None] = [None] * len(texts)
+        pending: list[int] = []
+        for i, key in enumerate(keys):
+            embedding = self.local.get(key)
+            if embedding is not None:
+                self.local.move_to_end(key)
+                metrics.inc("embedding_cache_local_hit")
+                results[i] = embedding
+            else:
+                pending.append(i)
+
+        if pending:
+            try:
+                raw_values = await self.redis_client.mget([keys[i] for i in pending])
+                for i, raw in zip(pending, raw_values):
+                    if raw:
+                        results[i] = unpack_embedding(raw)
+                        self.remember(keys[i], results[i])
+                        metrics.inc("embedding_cache_redis_hit")
+            except Exception as e:
+                logger.error(f"Embedding cache read failed: {e}")
+
+        metrics.inc("embedding_cache_miss", sum(1 for r in results if r is None))
+        return results
+
+    async def set_many(self, model: str, embeddings: dict[str, list[float]]):
+        pipe = self.redis_client.pipeline()
+        for text, embedding in embeddings.items():
+            key = self.key(text, model)
+            self.remember(key, embedding)
+            pipe.set(key, pack_embedding(embedding), ex=self.ttl)
+        try:
+            await pipe.execute()
+        except Exception as e:
+            logger.error(f"Embedding cache write failed: {e}")
+
 
 class QdrantHelper:
     def __init__(self):
-        self.qdrant_client = AsyncQdrantClient(url=settings.QDRANT_URL)
+        # long-lived pooled clients: one TLS handshake per connection, not per call
+        self.qdrant_client = AsyncQdrantClient(
+            url=settings.QDRANT_URL,
+            timeout=int(settings.HTTP_READ_TIMEOUT),
+            limits=http_limits(),
+            http2=settings.HTTP2,
+        )
+        self.http_client = httpx.AsyncClient(
+            http2=settings.HTTP2, limits=http_limits(), timeout=http_timeout()
+        )
+        self.openai_client = AsyncOpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            http_client=httpx.AsyncClient(
+                http2=settings.HTTP2, limits=http_limits(), timeout=http_timeout()
+            ),
+        )
+        self.providers = {
+            "jina": (self.embed_jina, JINA_MODEL),
+            "openai": (self.embed_openai, OPENAI_MODEL),
+        }
+        self.breakers = {
+            name: CircuitBreaker(
+                name=f"embedding_{name}",
+                failure_threshold=settings.EMBEDDING_BREAKER_FAILURES,
+                cooldown=settings.EMBEDDING_BREAKER_COOLDOWN,
+            )
+            for name in self.providers
+        }
+        self.embedding_cache = EmbeddingCache(
+            redis_url=settings.REDIS_URL,
+            max_size=settings.EMBEDDING_CACHE_SIZE,
+            ttl=settings.EMBEDDING_CACHE_TTL,
+        )
+
+    async def start(self):
+        """Open connections to the embedding endpoint, OpenAI and Qdrant ahead of the first turn"""
+        warmups = {
+            "jina": self.http_client.head(settings.EMBEDDING_URL),
+            "openai": self.openai_client.models.list(),
+            "qdrant": self.qdrant_client.collection_exists(settings.QDRANT_COLLECTION_NAME),
+        }
+        results = await asyncio.gather(*warmups.values(), return_exceptions=True)
+        for name, result in zip(warmups, results):
+            if isinstance(result, Exception):
+                logger.error(f"Warm-up of {name} client failed: {result}")
+        logger.info("Qdrant helper clients warmed up")
+
+    async def stop(self):
+        await self.http_client.aclose()
+        await self.openai_client.close()
+        await self.qdrant_client.close()
+        await self.embedding_cache.redis_client.close()
 
     async def embedder(self, query_str: str):
+        return (await self.embed_many([query_str]))[0]
+
+    async def embed_query(self, query_str: str) -> tuple[list[float], str]:
+        """embedder plus the model that produced the vector"""
+        embeddings, model = await self.embed_many_with_model([query_str])
+        return embeddings[0], model
+
+    async def embed_many(self, texts: list[str]) -> list[list[float]]:
+        return (await self.embed_many_with_model(texts))[0]
+
+    def preferred_model(self) -> str:
+        """Model of the provider embed_remote would try first"""
+        return JINA_MODEL if self.breakers["jina"].would_allow() else OPENAI_MODEL
+
+    async def embed_many_with_model(self, texts: list[str]) -> tuple[list[list[float]], str]:
+        """
+        Embed several texts, all with one model, and return that model.
+        Cache misses go to the provider in one request.
+        """
+        model = self.preferred_model()
+        embeddings = await self.embedding_cache.get_many(texts, model)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if not missing:
+            return embeddings, model
+
+        # identical texts in one batch are embedded once
+        unique_texts = list(dict.fromkeys(texts[i] for i in missing))
+        computed, used_model = await self.embed_remote(inputs=unique_texts)
+        by_text = dict(zip(unique_texts, computed))
+        await self.embedding_cache.set_many(used_model, by_text)
+        if used_model != model:
+            # the provider fell back: the cache hits are in the other vector space
+            metrics.inc("embedding_batch_model_switch")
+            hit_texts = [text for text in dict.fromkeys(texts) if text not in by_text]
+            by_text.update(await self.embed_with_model(used_model, hit_texts))
+            return [by_text[text] for text in texts], used_model
+
+        for i in missing:
+            embeddings[i] = by_text[texts[i]]
+        return embeddings, model
+
+    async def embed_with_model(self, model: str, texts: list[str]) -> dict[str, list[float]]:
+        """Embed texts with this exact model: cache first, then its provider"""
+        if not texts:
+            return {}
+        cached = await self.embedding_cache.get_many(texts, model)
+        by_text = {text: embedding for text, embedding in zip(texts, cached) if embedding is not None}
+        missing = [text for text in texts if text not in by_text]
+        if missing:
+            provider = next(name for name, (_, m) in self.providers.items() if m == model)
+            computed, _ = await self.call_provider(provider, missing)
+            computed_by_text = dict(zip(missing, computed))
+            await self.embedding_cache.set_many(model, computed_by_text)
+            by_text.update(computed_by_text)
+        return by_text
+
+    async def embed_jina(self, inputs: list[str]) -> list[list[float]]:
+        response = await self.http_client.post(
+            url=settings.EMBEDDING_URL,
+            headers={
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {settings.EMBEDDING_TOKEN}",
+            },
+            json={"model": JINA_MODEL, "input": inputs},
+        )
+        if response.status_code != 200:
+            raise ValueError(
+                f"Jina3 embedding API returned {response.status_code}"
+            )
+        response_dict = response.json()
+        data = sorted(response_dict["data"], key=lambda item: item.get("index", 0))
+        return [item["embedding"] for item in data]
+
+    async def embed_openai(self, inputs: list[str]) -> list[list[float]]:
+        response = await self.openai_client.embeddings.create(
+            input=inputs, model=OPENAI_MODEL, dimensions=1024
+        )
+        data = sorted(response.data, key=lambda item: item.index)
+        return [item.embedding for item in data]
+
+    async def call_provider(self, provider: str, inputs: list[str]) -> tuple[list[list[float]], str]:
+        """Call one provider, recording its latency and health"""
+        embed, model = self.providers[provider]
+        breaker = self.breakers[provider]
+        start = time.perf_counter()
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    url=settings.EMBEDDING_URL,
-                    headers={
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {settings.EMBEDDING_TOKEN}",
-                    },
-                    json={"model": "text-1024", "input": query_str},
-                )
-                if response.status_code != 200:
-                    raise ValueError(
-                        "Jina3 embedding API returned {response.status_code}"
-                    )
-            response_dict = response.json()
-            data = response_dict["data"]
-            embedding = data[0]["embedding"]
-            return embedding
-        except Exception as e:
-            logger.error(f"Jina3 embedding failed, using OpenAI: {e}")
+            embeddings = await embed(inputs)
+        except asyncio.CancelledError:
+            breaker.record_cancelled()
+            raise
+        except Exception:
+            breaker.record_failure()
+            metrics.inc(f"embedding_{provider}_errors")
+            raise
+        breaker.record_success()
+        metrics.observe(f"embedding_{provider}_seconds", time.perf_counter() - start)
+        return embeddings, model
+
+    def hedge_delay(self, provider: str) -> float:
+        """Wait this long for the provider before firing the secondary request"""
+        p95 = metrics.percentile(f"embedding_{provider}_seconds", 0.95)
+        if p95 is None:
+            return settings.EMBEDDING_HEDGE_MIN_DELAY
+        return max(settings.EMBEDDING_HEDGE_MIN_DELAY, p95)
+
+    async def embed_remote(self, inputs: list[str]) -> tuple[list[list[float]], str]:
+        """Jina first, OpenAI as fallback; a provider with an open breaker is skipped"""
+        if self.breakers["jina"].allow():
+            if settings.EMBEDDING_HEDGING:
+                return await self.embed_hedged(inputs, primary="jina", secondary="openai")
             try:
-                client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
-                response = await client.embeddings.create(
-                    input=query_str, model="text-embedding-3-small", dimensions=1024
-                )
-                embedding = response.data[0].embedding
-                return embedding
+                return await self.call_provider("jina", inputs)
+            except Exception as e:
+                logger.error(f"Jina3 embedding failed, using OpenAI: {e}")
+        else:
+            logger.debug("Jina3 breaker open, using OpenAI")
+
+        if self.breakers["openai"].allow():
+            try:
+                return await self.call_provider("openai", inputs)
             except Exception as openai_error:
                 logger.error(f"OpenAI embedding failed too: {openai_error}")
-                raise RuntimeError("Both embedding providers failed")
+        raise RuntimeError("Both embedding providers failed")
+
+    async def embed_hedged(
+        self, inputs: list[str], primary: str, secondary: str
+    ) -> tuple[list[list[float]], str]:
+        """Fire the secondary once the primary is slower than its p95; first success wins"""
+        tasks = {asyncio.create_task(self.call_provider(primary, inputs)): primary}
+        done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay(primary))
+        primary_failed = bool(done) and next(iter(done)).exception() is not None
+        if primary_failed:
+            logger.error(f"{primary} embedding failed: {next(iter(done)).exception()}")
+        if (not done or primary_failed) and self.breakers[secondary].allow():
+            metrics.inc("embedding_hedge_fired")
+            tasks[asyncio.create_task(self.call_provider(secondary, inputs))] = secondary
+
+        pending = {task for task in tasks if not task.done()}
+        try:
+            if done and not primary_failed:
+                return next(iter(done)).result()
+            while pending:
+                finished, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in finished:
+                    if task.exception() is None:
+                        if tasks[task] != primary:
+                            metrics.inc("embedding_hedge_won")
+                        return task.result()
+                    logger.error(f"{tasks[task]} embedding failed: {task.exception()}")
+        finally:
+            for task in pending:
+                task.cancel()
+        raise RuntimeError("Both embedding providers failed")
 
     async def retrieve_context(self, query_str: str) -> tuple[str, list[int]]:
         query = await self.embedder(query_str=query_str)
@@ -74,5 +343,65 @@ class QdrantHelper:
             labels.append(point.payload.get("label_title", ""))
         return labels
 
+    async def fill_embeddings(
+        self,
+        query_strs: list[str],
+        embeddings: list[list[float] | None] | None = None,
+        embedding_models: list[str | None] | None = None,
+    ) -> tuple[list[list[float]], str]:
+        """
+        Embed only the texts that have no usable vector in ``embeddings`` yet.
+
+        A stored vector is reused only if ``embedding_models`` says it comes
+        from the model in use; without ``embedding_models`` the caller vouches
+        for it. Returns the vectors and their model.
+        """
+        model = self.preferred_model()
+        queries = list(embeddings) if embeddings else [None] * len(query_strs)
+        if embedding_models is not None:
+            queries = [
+                query if stored_model == model else None
+                for query, stored_model in zip(queries, embedding_models)
+            ]
+        missing = [i for i, query in enumerate(queries) if query is None]
+        if not missing:
+            return queries, model
+        metrics.inc("embedding_fill_missing", len(missing))
+
+        computed, used_model = await self.embed_many_with_model([query_strs[i] for i in missing])
+        if used_model != model and len(missing) < len(queries):
+            # the provider fell back: the reused vectors are in the other space
+            return await self.embed_many_with_model(query_strs)
+        for i, query in zip(missing, computed):
+            queries[i] = query
+        return queries, used_model
+
+    async def retrieve_labels_batch(
+        self,
+        query_strs: list[str],
+        embeddings: list[list[float] | None] | None = None,
+    ) -> list[list[str]]:
+        """retrieve_labels for many texts: one embedding request, one batch query.
+
+        ``embeddings`` may carry vectors already stored for some of the texts;
+        only the missing ones are embedded.
+        """
+        if not query_strs:
+            return []
+        queries, _ = await self.fill_embeddings(query_strs, embeddings)
+
+        responses = await self.qdrant_client.query_batch_points(
+            collection_name=settings.QDRANT_COLLECTION_NAME,
+            requests=[
+                models.QueryRequest(query=query, with_payload=True, limit=5)
+                for query in queries
+            ],
+        )
+
+        return [
+            [point.payload.get("label_title", "") for point in response.points]
+            for response in responses
+        ]
+
 
 qdrant_helper = QdrantHelper()
@@ -3,43 +3,98 @@ from app.core.config import settings
 from app.schemas.chat import ChatRequest
 from typing import Optional, List, Dict
 import asyncio
+import hashlib
+import os
+import socket
+import time
+import uuid
 from app.core.logging import logger
+from app.core.metrics import metrics
 from datetime import datetime, timedelta,timezone
 import json
 from app.models.db_helper import db_helper
 from app.api.v1.chatbot import crud
-from zoneinfo import ZoneInfo
-from langchain_core.messages import HumanMessage, AIMessage
-from app.api.v1.chatbot.labels import (
-    LABELS,
-    SUCCESS_ID,
-    SUPPORT_ID,
-    SYSTEM_PROMPT_V3,
-    SYSTEM_PROMPT_V4
-)
-from app.core.langgraph.graph import agent, client
-from app.core.omnidesk.omnidesk_api import omnidesk_api
+from app.core.langgraph.turn_graph import turn_runner
+from app.models.outbox import outbox
 from app.models.qdrant_helper import qdrant_helper
+from app.models.redis_scripts import (
+    APPEND_MESSAGE,
+    DRAIN_BUFFER,
+    PUBLISH_DUE_BUFFERS,
+)
 
 from app.api.v1.chatbot.labels import OUTSIDE_WORKING_HOURS_RESPONSE
-from app.api.v1.chatbot.helper import is_working_hours
+from app.api.v1.chatbot.helper import is_complete_question, is_working_hours
 
 ALMATY_TZ = timezone(timedelta(hours=5))
 
 class RedisHelper:
     """Redis Helper class"""
 
-    def __init__(self, redis_url: str, buffer_timeout: int = 90):
+    def __init__(
+        self,
+        redis_url: str,
+        buffer_timeout: int = 90,
+        max_workers: int = 8,
+        claim_idle_seconds: int = 330,
+        lock_seconds: int = 300,
+        queue_wait_seconds: int = 900,
+        max_attempts: int = 3,
+    ):
         self.redis_url = redis_url
         self.buffer_timeout = buffer_timeout
         self.redis_client = redis.from_url(redis_url, decode_responses=True)
         self.background_task: Optional[asyncio.Task] = None
+        self.consumer_task: Optional[asyncio.Task] = None
+        self.listener_task: Optional[asyncio.Task] = None
         self.shutdown = False
 
+        # scheduler sleeps until the next deadline or until a new one is announced
+        self.DEADLINES_CHANNEL = "buffer_deadlines:changed"
+        self.scheduler_wakeup = asyncio.Event()
+        self.next_wakeup: Optional[float] = None
+        self.idle_timeout = 300
+
+        # worker pool: global in-flight cap + one task chain per chat
+        self.max_workers = max_workers
+        self.worker_slots = asyncio.Semaphore(max_workers)
+        self.chat_tasks: Dict[str, asyncio.Task] = {}
+        self.prewarm_tasks: Dict[str, asyncio.Task] = {}
+
+        # work stream shared by all replicas through one consumer group
+        self.STREAM_KEY = "buffer_stream"
+        self.STREAM_GROUP = "buffer_workers"
+        self.STREAM_MAXLEN = 10000
+        self.consumer_name = f"{socket.gethostname()}-{os.getpid()}"
+        self.claim_idle_ms = claim_idle_seconds * 1000
+        self.lock_seconds = lock_seconds
+        self.queue_wait_seconds = queue_wait_seconds
+        self.max_attempts = max_attempts
+        # buffered and in-flight messages must outlive the worst case before a
+        # flush drains them again: waiting for a worker, a replica that died
+        # mid-turn and its stream entry being reclaimed, and a turn holding the lock
+        self.inflight_ttl = queue_wait_seconds + claim_idle_seconds + lock_seconds
+        self.buffer_ttl = settings.BUFFER_TIMEOUT_MAX + self.inflight_ttl
+        self.publish_due_buffers = self.redis_client.register_script(
+            PUBLISH_DUE_BUFFERS
+        )
+        self.append_message = self.redis_client.register_script(APPEND_MESSAGE)
+        self.drain_buffer = self.redis_client.register_script(DRAIN_BUFFER)
+
         # redis key patterns
         self.BUFFER_KEY = "buffer_id:{chat_id}"
-        self.TIMER_KEY = "timer:{chat_id}"
+        self.INFLIGHT_KEY = "inflight:{chat_id}"
+        self.STATS_KEY = "buffer_stats:{chat_id}"
+        self.TURN_KEY = "turn:{chat_id}"
+        self.PREWARM_KEY = "prewarm:{chat_id}"
         self.PROCESSING_KEY = "lock:{chat_id}"
+        # sorted set: member = chat_id, score = epoch seconds when buffer is due
+        self.DEADLINES_KEY = "buffer_deadlines"
+        # turns that failed max_attempts times, newest first
+        self.DEAD_LETTER_KEY = "buffer_dead_letter"
+        self.DEAD_LETTER_MAXLEN = 1000
+        # image description / audio transcript by sha256 of the attachment bytes
+        self.ATTACHMENT_KEY = "attachment:{kind}:{version}:{digest}"
 
     async def start(self):
         """Start function"""
@@ -47,10 +102,19 @@ class RedisHelper:
             await self.redis_client.ping()
             logger.info("redis connected successfully")
 
+            await self.ensure_consumer_group()
+
+            if self.listener_task is None or self.listener_task.done():
+                self.listener_task = asyncio.create_task(self.deadline_listener())
+
             if self.background_task is None or self.background_task.done():
                 self.background_task = asyncio.create_task(self.background_processor())
                 logger.info("Background processor started")
 
+            if self.consumer_task is None or self.consumer_task.done():
+                self.consumer_task = asyncio.create_task(self.stream_consumer())
+                logger.info(f"Stream consumer {self.consumer_name} started")
+
         except Exception as e:
             logger.error(f"Redis connection failed : {str(e)}")
             raise
@@ -61,72 +125,290 @@ class RedisHelper:
 
         if self.background_task and not self.background_task.done():
             self.background_task.cancel()
+        if self.consumer_task and not self.consumer_task.done():
+            self.consumer_task.cancel()
+        if self.listener_task and not self.listener_task.done():
+            self.listener_task.cancel()
+        for task in list(self.chat_tasks.values()) + list(self.prewarm_tasks.values()):
+            task.cancel()
         await self.redis_client.close()
         logger.info("Redis buffer manager stopped")
 
+    async def ensure_consumer_group(self):
+        """Create the work stream and its consumer group if they do not exist"""
+        try:
+            await self.redis_client.xgroup_create(
+                name=self.STREAM_KEY, groupname=self.STREAM_GROUP, id="0", mkstream=True
+            )
+            logger.info(f"Created consumer group {self.STREAM_GROUP}")
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
     async def background_processor(self) -> int:
-        """Background processor function"""
+        """Publish due buffers, then sleep until the next deadline.
+
+        There is no fixed poll interval: the sleep is cut short by
+        ``deadline_listener`` when an earlier deadline is announced, and
+        when no chat is buffered Redis is only touched every ``idle_timeout``.
+        """
         while not self.shutdown:
             try:
-                processed_count = await self.process_expired_buffers()
+                # any deadline announced while publishing wakes us straight away
+                self.next_wakeup = None
+                self.scheduler_wakeup.clear()
+                processed_count, now, delay = await self.process_expired_buffers()
                 if processed_count > 0:
-                    logger.info(f"Processed {processed_count} expired chat buffers")
-                await asyncio.sleep(10)
+                    logger.info(f"Published {processed_count} expired chat buffers")
+
+                self.next_wakeup = now + delay
+                try:
+                    await asyncio.wait_for(self.scheduler_wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
             except asyncio.CancelledError:
                 break
             except Exception as e:
                 logger.error(f"Background processor error: {str(e)}")
                 await asyncio.sleep(30)
 
-    async def process_expired_buffers(self) -> bool:
-        """Process expired buffers function"""
-        processed_count = 0
-        now = datetime.now()
+    async def redis_now(self) -> float:
+        """Current epoch time taken from the Redis server clock.
 
+        All replicas share one Redis, so deadlines written by one node and
+        checked by another are compared against the same clock.
+        """
+        seconds, microseconds = await self.redis_client.time()
+        return seconds + microseconds / 1_000_000
+
+    async def process_expired_buffers(self) -> tuple[int, float, float]:
+        """Move due chats from the deadline index to the work stream.
+
+        The move runs as one script, so concurrent replicas never publish
+        the same deadline twice. Returns the number of published chats, the
+        Redis server time and the seconds until the next deadline.
+        """
         try:
-            async for timer_key in self.redis_client.scan_iter(match="timer:*"):
-                try:
-                    expire_time_str = await self.redis_client.get(name=timer_key)
-                    if not expire_time_str:
-                        continue
+            published, now, next_due = await self.publish_due_buffers(
+                keys=[self.DEADLINES_KEY, self.STREAM_KEY],
+                args=[1000, self.STREAM_MAXLEN],
+            )
+        except Exception as e:
+            logger.error(f"Error publishing expired buffers: {str(e)}")
+            raise
+        metrics.inc("buffer_published", len(published))
 
-                    expire_time = datetime.fromisoformat(expire_time_str)
+        now = float(now)
+        if next_due is None:
+            delay = self.idle_timeout
+        else:
+            delay = min(self.idle_timeout, max(0.0, float(next_due) - now))
+        return len(published), now, delay
 
-                    if (
-                        expire_time <= now
-                    ):  # 1 case : 10h:48m:30s < 10h:48m:15s => false // 2 case : 10h:48m:30s <= 10h:48m:31s
-                        chat_id = timer_key.split(":", 1)[1]
+    async def deadline_listener(self):
+        """Wake the scheduler when a deadline earlier than its current sleep is set"""
+        while not self.shutdown:
+            pubsub = self.redis_client.pubsub()
+            try:
+                await pubsub.subscribe(self.DEADLINES_CHANNEL)
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    try:
+                        deadline = float(message["data"])
+                    except ValueError:
+                        deadline = 0.0
+                    # both sides are Redis server time
+                    if self.next_wakeup is None or deadline < self.next_wakeup:
+                        self.scheduler_wakeup.set()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Deadline listener error: {str(e)}")
+                await asyncio.sleep(5)
+            finally:
+                await pubsub.aclose()
+
+    async def requeue_chat(self, chat_id: str, delay: float):
+        """Schedule another look at a chat unless it already has a deadline"""
+        expire_at = await self.redis_now() + delay
+        pipe = self.redis_client.pipeline()
+        pipe.zadd(self.DEADLINES_KEY, {chat_id: expire_at}, nx=True)
+        pipe.publish(self.DEADLINES_CHANNEL, str(expire_at))
+        await pipe.execute()
 
-                        if await self.process_chat_buffer(chat_id=chat_id):
-                            processed_count += 1
+    async def stream_consumer(self):
+        """Read due chats from the consumer group and feed the worker pool"""
+        last_claim = 0.0
+        loop = asyncio.get_running_loop()
 
-                except Exception as e:
-                    logger.error(f"Error processing timer {timer_key}: {str(e)}")
+        while not self.shutdown:
+            try:
+                free_slots = self.max_workers - len(self.chat_tasks)
+                if free_slots <= 0:
+                    await asyncio.wait(
+                        list(self.chat_tasks.values()),
+                        return_when=asyncio.FIRST_COMPLETED,
+                    )
+                    continue
+
+                if loop.time() - last_claim >= self.claim_idle_ms / 1000 / 2:
+                    last_claim = loop.time()
+                    await self.reclaim_stale_entries(count=free_slots)
                     continue
 
+                response = await self.redis_client.xreadgroup(
+                    groupname=self.STREAM_GROUP,
+                    consumername=self.consumer_name,
+                    streams={self.STREAM_KEY: ">"},
+                    count=free_slots,
+                    block=5000,
+                )
+                for _, entries in response or []:
+                    for entry_id, fields in entries:
+                        self.schedule_stream_entry(entry_id=entry_id, fields=fields)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Stream consumer error: {str(e)}")
+                await asyncio.sleep(5)
+
+    async def reclaim_stale_entries(self, count: int):
+        """Take over entries left pending by a consumer that died mid-flush"""
+        result = await self.redis_client.xautoclaim(
+            name=self.STREAM_KEY,
+            groupname=self.STREAM_GROUP,
+            consumername=self.consumer_name,
+            min_idle_time=self.claim_idle_ms,
+            start_id="0-0",
+            count=count,
+        )
+        for entry_id, fields in result[1]:
+            if not fields:  # entry was trimmed from the stream
+                await self.ack_stream_entry(entry_id)
+                continue
+            logger.info(f"Reclaimed stale stream entry {entry_id} for chat {fields.get('chat_id')}")
+            metrics.inc("buffer_reclaimed")
+            self.schedule_stream_entry(entry_id=entry_id, fields=fields)
+
+    def schedule_stream_entry(self, entry_id: str, fields: dict):
+        chat_id = fields.get("chat_id")
+        if not chat_id:
+            logger.error(f"Stream entry {entry_id} has no chat_id")
+            asyncio.create_task(self.ack_stream_entry(entry_id))
+            return
+        self.schedule_chat_buffer(
+            chat_id=chat_id,
+            due_at=float(fields.get("due_at", 0)),
+            entry_id=entry_id,
+        )
+
+    async def ack_stream_entry(self, entry_id: str):
+        pipe = self.redis_client.pipeline()
+        pipe.xack(self.STREAM_KEY, self.STREAM_GROUP, entry_id)
+        pipe.xdel(self.STREAM_KEY, entry_id)
+        await pipe.execute()
+
+    def schedule_chat_buffer(
+        self, chat_id: str, due_at: float, entry_id: Optional[str] = None
+    ) -> asyncio.Task:
+        """Queue a buffer flush on the worker pool.
+
+        Flushes of the same chat are chained so they run in arrival order;
+        different chats run in parallel up to ``max_workers``.
+        """
+        previous = self.chat_tasks.get(chat_id)
+        task = asyncio.create_task(
+            self.run_chat_buffer(
+                chat_id=chat_id, due_at=due_at, previous=previous, entry_id=entry_id
+            )
+        )
+        self.chat_tasks[chat_id] = task
+        metrics.add_gauge("buffer_queue_depth", 1)
+
+        def _done(t: asyncio.Task):
+            if self.chat_tasks.get(chat_id) is t:
+                del self.chat_tasks[chat_id]
+
+        task.add_done_callback(_done)
+        return task
+
+    async def run_chat_buffer(
+        self,
+        chat_id: str,
+        due_at: float,
+        previous: Optional[asyncio.Task] = None,
+        entry_id: Optional[str] = None,
+    ) -> bool:
+        """Wait for the chat's previous flush and a free worker slot, then flush"""
+        queued = True
+        try:
+            if previous is not None and not previous.done():
+                await asyncio.wait([previous])
+
+            async with self.worker_slots:
+                metrics.add_gauge("buffer_queue_depth", -1)
+                queued = False
+                metrics.add_gauge("buffer_in_flight", 1)
+                try:
+                    wait_time = max(0.0, await self.redis_now() - due_at)
+                    metrics.observe("buffer_wait_seconds", wait_time)
+                    if wait_time > self.queue_wait_seconds:
+                        # past this the buffer TTL no longer covers the wait
+                        metrics.inc("buffer_wait_over_budget")
+                        logger.error(
+                            f"Chat {chat_id} waited {wait_time:.0f}s for a worker, "
+                            f"over BUFFER_QUEUE_WAIT_MAX ({self.queue_wait_seconds}s)"
+                        )
+                    logger.debug(f"Chat {chat_id} waited {wait_time:.2f}s for a worker")
+
+                    with metrics.timer("buffer_flush_seconds"):
+                        success = await self.process_chat_buffer(chat_id=chat_id)
+                    if success:
+                        metrics.inc("buffer_flushed")
+                        logger.info(f"Processed expired chat buffer {chat_id}")
+                    else:
+                        metrics.inc("buffer_flush_failed")
+                    # a flush that never finishes stays pending and is reclaimed later
+                    if entry_id is not None:
+                        await self.ack_stream_entry(entry_id)
+                    return success
+                finally:
+                    metrics.add_gauge("buffer_in_flight", -1)
         except Exception as e:
-            logger.error(f"Error scanning expired buffers: {str(e)}")
-        return processed_count
+            logger.error(f"Worker error for chat {chat_id}: {str(e)}")
+            return False
+        finally:
+            if queued:
+                metrics.add_gauge("buffer_queue_depth", -1)
 
     async def process_chat_buffer(self, chat_id: str):
         """process_chat_buffer function"""
         buffer_key = self.BUFFER_KEY.format(chat_id=chat_id)
-        timer_key = self.TIMER_KEY.format(chat_id=chat_id)
+        inflight_key = self.INFLIGHT_KEY.format(chat_id=chat_id)
+        turn_key = self.TURN_KEY.format(chat_id=chat_id)
         processing_key = self.PROCESSING_KEY.format(chat_id=chat_id)
+        lock_aquired = False
+        attempt = 0
+        turn_id = None
 
         try:
             lock_aquired = await self.redis_client.set(
                 name=processing_key,
                 value="processing",
                 nx=True,
-                ex=300,  # I should think about time !
+                ex=self.lock_seconds,
             )
 
             if not lock_aquired:
                 logger.debug(f"Chat {chat_id} already being processed")
+                # another replica holds the chat; look again once it is done
+                await self.requeue_chat(chat_id=chat_id, delay=10)
                 return False
-            messages_json = await self.redis_client.lrange(
-                name=buffer_key, start=0, end=-1
+            # take ownership of the buffered messages; anything sent from now on
+            # goes to a fresh buffer with its own debounce window
+            messages_json, attempt, turn_id = await self.drain_buffer(
+                keys=[buffer_key, inflight_key, turn_key], args=[self.inflight_ttl]
             )
 
             if not messages_json:
@@ -135,7 +417,7 @@ class RedisHelper:
 
             messages = []
 
-            for msg_json in reversed(messages_json):
+            for msg_json in messages_json:
                 try:
                     messages.append(json.loads(msg_json))
 
@@ -151,7 +433,7 @@ class RedisHelper:
             )
 
             success = await self.concatenate_process_and_save(
-                messages=messages
+                messages=messages, turn_id=turn_id
             )  # MY BACKEND LOGIC SHOULD BE HERE PROCESSING Q&A
 
             if success:
@@ -162,36 +444,96 @@ class RedisHelper:
                 return True
             else:
                 logger.error(f"Failed to process buffer for chat {chat_id}")
+                await self.retry_turn(
+                    chat_id=chat_id,
+                    messages_json=messages_json,
+                    attempt=attempt,
+                    turn_id=turn_id,
+                )
                 return False
 
         except Exception as e:
             logger.error(f"Error processing chat buffer {chat_id}: {str(e)}")
+            if attempt:
+                # the messages are in flight already; retry like a failed turn
+                await self.retry_turn(
+                    chat_id=chat_id,
+                    messages_json=messages_json,
+                    attempt=attempt,
+                    turn_id=turn_id,
+                )
             return False
         finally:
-            await self.redis_client.delete(processing_key)
+            if lock_aquired:
+                await self.redis_client.delete(processing_key)
+
+    async def retry_turn(
+        self, chat_id: str, messages_json: List[str], attempt: int, turn_id: str
+    ):
+        """Schedule another attempt at a failed turn, or dead-letter it.
+
+        Every attempt makes a full LLM call, so after ``max_attempts`` the
+        in-flight messages are moved to the dead-letter list instead and the
+        turn's checkpoints are deleted.
+        """
+        try:
+            if attempt < self.max_attempts:
+                await self.requeue_chat(chat_id=chat_id, delay=10 * attempt)
+                return
+
+            metrics.inc("buffer_dead_lettered")
+            logger.error(
+                f"Chat {chat_id} failed {attempt} attempts, "
+                f"moving its turn to {self.DEAD_LETTER_KEY}"
+            )
+            entry = {
+                "chat_id": chat_id,
+                "attempts": attempt,
+                "failed_at": datetime.now(ALMATY_TZ).isoformat(),
+                "messages": [json.loads(msg_json) for msg_json in messages_json],
+            }
+            pipe = self.redis_client.pipeline()
+            pipe.lpush(self.DEAD_LETTER_KEY, json.dumps(entry))
+            pipe.ltrim(self.DEAD_LETTER_KEY, 0, self.DEAD_LETTER_MAXLEN - 1)
+            await pipe.execute()
+            await self.cleanup_redis_keys(chat_id=chat_id)
+            await turn_runner.delete_thread(self.turn_thread_id(chat_id, turn_id))
+        except Exception as e:
+            logger.error(f"Error scheduling retry for chat {chat_id}: {str(e)}")
 
     async def cleanup_redis_keys(self, chat_id: str):
-        """cleanup_redis_key function"""
-        buffer_key = self.BUFFER_KEY.format(chat_id=chat_id)
-        timer_key = self.TIMER_KEY.format(chat_id=chat_id)
+        """Drop the in-flight messages of a finished turn.
+
+        The buffer and its deadline are left alone: they hold messages that
+        arrived while the turn was being processed. Pre-warmed context is
+        dropped because the saved turn changed the chat history.
+        """
+        inflight_key = self.INFLIGHT_KEY.format(chat_id=chat_id)
+        turn_key = self.TURN_KEY.format(chat_id=chat_id)
         processing_key = self.PROCESSING_KEY.format(chat_id=chat_id)
+        prewarm_key = self.PREWARM_KEY.format(chat_id=chat_id)
 
-        pipe = self.redis_client.pipeline()
-        pipe.delete(buffer_key, timer_key, processing_key)
-        await pipe.execute()
+        await self.redis_client.delete(inflight_key, turn_key, processing_key, prewarm_key)
 
         logger.debug(f"Cleaned up Redis keys for chat {chat_id}")
 
-    async def concatenate_process_and_save(self, messages: List[Dict]) -> bool:
+    async def concatenate_process_and_save(self, messages: List[Dict], turn_id: str) -> bool:
         chat_id = messages[0]["chat_id"]
         user_id = messages[0]["user_id"]
+        turn_started = time.time()
         
         now = datetime.now(ALMATY_TZ)
         if not is_working_hours(now):
             logger.info(f"chat_request {chat_id} received outside working hours")
             try:
-                code = await omnidesk_api.send_message(content=OUTSIDE_WORKING_HOURS_RESPONSE, chat_id=chat_id)
-                logger.info(f"message sended {code}")
+                await outbox.enqueue(
+                    chat_id=chat_id,
+                    kind="message",
+                    key=outbox.idempotency_key(chat_id, "message", turn_started),
+                    content=OUTSIDE_WORKING_HOURS_RESPONSE,
+                    turn_started=turn_started,
+                )
+                logger.info(f"message queued for chat {chat_id}")
                 if messages:
                     concatenated_messages = " ".join([msg["message"] for msg in messages])
                     async with db_helper.session_factory() as session:
@@ -217,337 +559,208 @@ class RedisHelper:
 
             concatenated_messages = " ".join([msg["message"] for msg in messages])
             try:
-                retrieved_context, point_ids = await qdrant_helper.retrieve_context(
-                    concatenated_messages
+                prewarmed = await self.load_prewarmed(
+                    chat_id=chat_id, fingerprint=self.turn_fingerprint(messages)
                 )
+                result = await turn_runner.run(
+                    state={
+                        "chat_id": chat_id,
+                        "user_id": user_id,
+                        "concatenated_messages": concatenated_messages,
+                        "turn_started": turn_started,
+                        "prewarmed": prewarmed,
+                    },
+                    thread_id=self.turn_thread_id(chat_id, turn_id),
+                )
+                metrics.observe("turn_total_seconds", time.time() - turn_started)
+                logger.debug({"response": result.get("response"), "tokens": result.get("tokens")})
+                return True
 
-                async with db_helper.session_factory() as session:
-                    try:
-                        history = await crud.get_chat_history( ## first query to db
-                            session=session, chat_id=chat_id
-                        )
-                    except Exception as e:
-                        logger.error(f"Error getting chat history: {str(e)}")
-                        history = []
-
-                    history_lines = []
-                    for msg in history[-10:]:
-                        local_time = msg.created_at.astimezone(ZoneInfo("Asia/Almaty"))
-                        history_lines.append(
-                            f"User({local_time.strftime('%Y-%m-%d %H:%M:%S %z')}): {msg.message}"
-                        )
-                        if msg.response:
-                            history_lines.append(f"Bot: {msg.response}")
-
-                    formatted_history = "\n".join(history_lines)
-
-                    current_time = datetime.now().astimezone(ZoneInfo("Asia/Almaty"))
-
-                    greeting_words = [
-                        "привет",
-                        "здравствуйте",
-                        "здравствуй",
-                        "доброе утро",
-                        "добрый день",
-                        "добрый вечер",
-                        "хай",
-                        "hello",
-                        "hi","сәлем","сәлеметсізбе","салеметсизбе","кайырлы кун","қайырлы күн"
-                        "Я AI-ассистент TrustMe."
-                    ]
-                    recent_threshold = current_time - timedelta(hours=1)
-                    found_recent_greeting = False
-                    for msg in history[-10:]:
-                        try:
-                            msg_time = msg.created_at.astimezone(ZoneInfo("Asia/Almaty"))
-                        except Exception:
-                            msg_time = current_time
-                        if msg_time >= recent_threshold:
-                            text = (msg.message or "").lower()
-                            response_text = (msg.response or "").lower()
-                            if any(g in text for g in greeting_words) or any(
-                                g in response_text for g in greeting_words
-                            ):
-                                found_recent_greeting = True
-                                break
-
-                    prompt = f"""
-                        --- Chat History (last 10 messages) ---
-                        {formatted_history}
-
-                        --- Retrieved Context (top 5 results) ---
-                        {retrieved_context}
-
-                        --- User Query (current message) ---
-                        User({current_time.strftime('%Y-%m-%d %H:%M:%S %z')}): {concatenated_messages}
-
-                        """
-                    llm_message = HumanMessage(content=prompt)
-                    try:
-                        system_message = AIMessage(content=SYSTEM_PROMPT_V4)
-                        result = await agent.ainvoke(
-                            {"last_message": llm_message, "system_message": system_message}
-                        )
-                        response_invoke = result["response"]
-                        tokens_used = result["tokens"]
-
-                        logger.info(
-                            f"LLM responded for chat {chat_id}, tokens used: {tokens_used}"
-                        )
-                    except Exception as e:
-                        logger.error(f"LLM processing failed: {str(e)}")
-                        return False
+            except Exception as e:
+                logger.error(f"Error concatenate and save: {str(e)}")
+                return False
 
-                    try:
-                        if found_recent_greeting:
-                            system_instr = (
-                                "Ты текстовый фильтр. Удали приветствия в начале текста плюс слово 'Я AI-ассистент TrustMe.' "
-                                "(например 'Здравствуйте', 'Добрый день', 'Привет' и т.п.). "
-                                "Не добавляй ничего взамен. Не объясняй свои действия. "
-                                "Верни только очищенный текст."
-                                "Не используйте звёздочки в любом виде: никаких **жирных**, *курсива* и обрамления текста звёздочками. Для списков применяйте нумерацию «1., 2.» или тире «-» без звёздочек."
-                            )
-                        else:
-                            system_instr = (
-                                "Ты текстовый фильтр. Если в тексте нет приветствия, добавь одно короткое уместное "
-                                "приветствие в начале (например 'Здравствуйте! Я AI-ассистент TrustMe.'), затем оставь текст без изменений. "
-                                "Не объясняй свои действия. Верни только финальный текст."
-                                "Не используйте звёздочки в любом виде: никаких **жирных**, *курсива* и обрамления текста звёздочками. Для списков применяйте нумерацию «1., 2.» или тире «-» без звёздочек."
-                            )
+    @staticmethod
+    def turn_thread_id(chat_id: str, turn_id: str) -> str:
+        # one checkpoint thread per turn; retries of the turn resume it
+        return f"{chat_id}:{turn_id}"
 
-                        cleaned_response = await client.chat.completions.create(
-                            model="gpt-4o",
-                            response_format={"type": "text"},
-                            messages=[
-                                {"role": "system", "content": system_instr},
-                                {"role": "user", "content": response_invoke},
-                            ],
-                            temperature=0,
-                        )
-                        response_invoke = cleaned_response.choices[0].message.content
-                        logger.debug(f"Cleaned response: {response_invoke}")
-                    except Exception as e:
-                        logger.error(f"Error cleaning response: {str(e)}")
+    @staticmethod
+    def turn_fingerprint(messages: List[Dict]) -> str:
+        # message ids tell apart a later turn that repeats the same text
+        key = json.dumps([[msg.get("id"), msg["message"]] for msg in messages])
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
 
-                    try:
-                        saved = await crud.save_message( ## second query to db
-                            session=session,
-                            user_id=int(user_id),
-                            chat_id=chat_id,
-                            last_message=concatenated_messages,
-                            response=response_invoke,
-                            retrieved=point_ids,
-                        )
-                    except Exception as e:
-                        logger.error(f"ERROR SAVE MESSAGE {str(e)}")
-                    
+    async def fetch_history(self, chat_id: str) -> list:
+        async with db_helper.session_factory() as session:
+            try:
+                return await crud.get_chat_history(session=session, chat_id=chat_id)
+            except Exception as e:
+                logger.error(f"Error getting chat history: {str(e)}")
+                return []
+
+    async def retrieve_turn_context(
+        self, chat_id: str, concatenated_messages: str
+    ) -> tuple[str, list[int], list]:
+        """Embedding + Qdrant search and the chat history query, run concurrently"""
+        (retrieved_context, point_ids), history = await asyncio.gather(
+            qdrant_helper.retrieve_context(concatenated_messages),
+            self.fetch_history(chat_id=chat_id),
+        )
+        return retrieved_context, point_ids, history
+
+    async def get_attachment_content(self, kind: str, version: str, digest: str) -> Optional[str]:
+        try:
+            return await self.redis_client.get(
+                self.ATTACHMENT_KEY.format(kind=kind, version=version, digest=digest)
+            )
+        except Exception as e:
+            logger.error(f"Error reading attachment cache: {str(e)}")
+            return None
 
-                    try:
-                        code = await omnidesk_api.send_message(
-                            content=response_invoke, chat_id=chat_id
-                        )
-                        logger.info(f"message sended {code}")
-                    except Exception as e:
-                        import traceback
-                        logger.error(f"ERROR SEND MESSAGE {str(e)}")
-                        logger.error(traceback.format_exc())
+    async def set_attachment_content(self, kind: str, version: str, digest: str, content: str):
+        try:
+            await self.redis_client.set(
+                self.ATTACHMENT_KEY.format(kind=kind, version=version, digest=digest),
+                content,
+                ex=settings.ATTACHMENT_CACHE_TTL,
+            )
+        except Exception as e:
+            logger.error(f"Error writing attachment cache: {str(e)}")
 
-                    try:
-                        prompt_human_help = f"""
-                                --- История чата (последние 10 сообщений) ---
-                                {formatted_history}
-
-                                --- Запрос клиента (текущее сообщение) ---
-                                Пользователь({current_time.strftime('%Y-%m-%d %H:%M:%S %z')}): {concatenated_messages}
-
-                                Ответ на текущее сообщение от ИИ, используя RAG: {response_invoke}
-
-                                --- Классификация запроса: ---
-                                Проанализируй запрос. Верни `True`, если нужен реальный человек для ответа, и `False`, если ИИ может ответить самостоятельно, используя доступные данные или RAG.
-
-                                Важно:
-                                1. Если вопрос связан с тарифами, пакетами или стоимостью услуг — сразу возвращай `response_required: true`, даже если есть данные в RAG.
-                                2. Если запрос общий и ИИ может ответить сам — возвращай `response_required: false`.
-                                4. Если сообщение связано с системными уведомлениями (например, содержит строки "=== SYSTEM WZ ===" или "Check this message on your device") — сразу возвращай `response_required: true` (чтобы подключился человек).
-                                5. Если сообщение равно "Подождите, пожалуйста, скоро ответит специалист." — сразу возвращай `response_required: true`.
-                                6. Ответ должен быть строго в формате JSON, например:
-
-                                Формат ответа (пример):
-                                {{
-                                "response_required": true
-                                }}
-                            """
-                        response_human_help = await client.chat.completions.create(
-                            model="gpt-4o",
-                            response_format={"type": "json_object"},
-                            messages=[{"role": "user", "content": prompt_human_help}],
-                            temperature=0,
-                        )
-                        need_human_help = json.loads(
-                            response_human_help.choices[0].message.content
-                        )
-                        logger.debug(f"response from llm human help : {need_human_help}")
-                    except Exception as e:
-                        logger.error(f"Error llm call for human_help : {str(e)}")
+    async def load_prewarmed(self, chat_id: str, fingerprint: str) -> Optional[dict]:
+        """Context pre-warmed while the user was typing, if it is still valid for this turn"""
+        prewarm_key = self.PREWARM_KEY.format(chat_id=chat_id)
+        try:
+            cached = await self.redis_client.get(prewarm_key)
+            if not cached:
+                metrics.inc("prewarm_miss")
+                return None
+            data = json.loads(cached)
+            if data["fingerprint"] != fingerprint:
+                metrics.inc("prewarm_stale")
+                return None
+            metrics.inc("prewarm_hit")
+            return data
+        except Exception as e:
+            logger.error(f"Error reading prewarmed context for chat {chat_id}: {str(e)}")
+            return None
+
+    def schedule_prewarm(self, chat_id: str):
+        """Restart the chat's pre-warm; the previous one is for an outdated buffer"""
+        previous = self.prewarm_tasks.get(chat_id)
+        if previous is not None and not previous.done():
+            previous.cancel()
+        task = asyncio.create_task(self.prewarm_turn_context(chat_id=chat_id))
+        self.prewarm_tasks[chat_id] = task
+
+        def _done(t: asyncio.Task):
+            if self.prewarm_tasks.get(chat_id) is t:
+                del self.prewarm_tasks[chat_id]
+
+        task.add_done_callback(_done)
+
+    async def prewarm_turn_context(self, chat_id: str):
+        """Retrieve context and history for the current buffer during the debounce window.
+
+        The result is keyed by a fingerprint of the buffered messages, ids
+        included, so a flush only uses it for exactly those messages: not once
+        another message arrived, and not for a later turn repeating the same
+        text when this pre-warm finishes after the flush already cleaned up.
+        """
+        buffer_key = self.BUFFER_KEY.format(chat_id=chat_id)
+        inflight_key = self.INFLIGHT_KEY.format(chat_id=chat_id)
+        processing_key = self.PROCESSING_KEY.format(chat_id=chat_id)
+        prewarm_key = self.PREWARM_KEY.format(chat_id=chat_id)
 
-                    if need_human_help and need_human_help.get("response_required"):
-                        try:
-                            result = await omnidesk_api.call_human(
-                                chat_id=chat_id, user_id=user_id, message="ВЫЗОВ МЕНЕДЖЕРА"
-                            )
-                            logger.debug(f"Result from call_human() : {result}")
-                        except Exception as e:
-                            logger.error(f"Error call human : {str(e)}")
-
-                    last_ten_msg = await crud.get_chat_history(session=session, chat_id=chat_id) ## 3
-                    chat = await crud.get_chat_by_id(session=session, chat_id=chat_id) ## 4
-
-                    if len(last_ten_msg) == 10:
-                        if not chat.labels_and_group:
-                            messages_for_label = ""
-                            labels: list[str] = []
-
-                            for m in last_ten_msg:
-                                messages_for_label += (
-                                    f"User message:{m.message}\n Bot response:{m.response}\n"
-                                )
-                                retrieved_labels = await qdrant_helper.retrieve_labels(
-                                    query_str=m.message
-                                )
-                                labels.extend(retrieved_labels)
-
-                            labels_str = ", ".join(labels)
-                            logger.debug(f"RETRIEVED LABELS {labels_str}")
-
-                            prompt = f"""
-                            Ты — классификатор чата.
-
-                            Твоя задача:
-                            1. Проанализировать последние 10 сообщений чата.
-                            2. Определить список релевантных меток (labels) анализируя Сообщения чата и Retrieved labels со списком доступных меток.
-                            3. Определить группу (group) по следующим правилам:
-                            - Если клиент новый → вернуть "Success_ID".
-                            - Если клиент взаимодействует меньше 2 месяцев → вернуть "Success_ID".
-                            - Если клиент не новый и взаимодействует больше 2 месяцев → вернуть "Support_ID".
-
-                            Важно:
-                            - Ответь строго в формате **валидного JSON**.
-                            - Не добавляй никаких пояснений или текста вне JSON.
-                            - Используй только указанные ID меток и групп.
-
-                            Сообщения чата:
-                            {messages_for_label}
-                            
-                            Retrieved labels using knowledge base:
-                            {labels_str}
-
-                            Список доступных меток:
-                            {LABELS}
-
-                            Список доступных групп:
-                            Success_ID = {SUCCESS_ID}
-                            Support_ID = {SUPPORT_ID}
-
-                            Формат ответа (пример):
-                            {{
-                                "labels": [id_label_1, id_label_2],
-                                "group": "96756"
-                            }}
-                            """
-
-                            response = await client.chat.completions.create(
-                                model="gpt-4o",
-                                response_format={"type": "json_object"},
-                                messages=[
-                                    {
-                                        "role": "system",
-                                        "content": "Ты помощник-классификатор. Отвечай строго в JSON формате.",
-                                    },
-                                    {"role": "user", "content": prompt},
-                                ],
-                                temperature=0,
-                            )
-                            result_labels_and_group = json.loads(
-                                response.choices[0].message.content
-                            )
-                            tokens_2 = response.usage.total_tokens
-                            logger.debug(f"labels and group: {result}")
-                            logger.debug(
-                                f"labels: {result_labels_and_group['labels']}, group {result_labels_and_group['group']}"
-                            )
-                            print(
-                                f"labels: {result_labels_and_group['labels']}, group {result_labels_and_group['group']}"
-                            )
+        try:
+            if not is_working_hours(datetime.now(ALMATY_TZ)):
+                return
 
-                            try:
-                                request_set_label = await omnidesk_api.set_labels_and_group(
-                                    chat_id=chat_id,
-                                    labels=result_labels_and_group["labels"],
-                                    group=result_labels_and_group["group"],
-                                )
-                            except Exception as e:
-                                logger.error(f"ERROR SETTING LABELS AND GROUP {str(e)}")
-
-                            try:
-                                set_true = await crud.set_labels_group( ## 5
-                                    session=session, chat_id=chat_id
-                                )
-                            except Exception as e:
-                                logger.error(f"ERROR SET LABELS AND GROUP {str(e)}")
-                    logger.debug(
-                        {
-                            "response": response_invoke,
-                            "prompt sended": system_message,
-                            # "tokens_used":tokens_1+tokens_2,
-                            "conversation": prompt,
-                            "saved": saved.chat_id,
-                            # "code":code,
-                            # "labels_and_group":result_labels_and_group,
-                            # "request_set_label_code":request_set_label,
-                            # "set_true":set_true
-                        }
-                    )
+            pipe = self.redis_client.pipeline()
+            pipe.exists(processing_key)
+            pipe.lrange(inflight_key, 0, -1)
+            pipe.lrange(buffer_key, 0, -1)
+            processing, inflight_json, buffer_json = await pipe.execute()
+            if processing:
+                # history is about to change; the flush will load it itself
+                return
+
+            # same order and text as the drained turn in process_chat_buffer
+            messages = [json.loads(m) for m in inflight_json + list(reversed(buffer_json))]
+            if not messages:
+                return
+            concatenated_messages = " ".join([msg["message"] for msg in messages])
 
-                    return True
+            with metrics.timer("prewarm_seconds"):
+                retrieved_context, point_ids, history = await self.retrieve_turn_context(
+                    chat_id=chat_id, concatenated_messages=concatenated_messages
+                )
 
-            except Exception as e:
-                logger.error(f"Error concatenate and save: {str(e)}")
-                return False
+            data = {
+                "fingerprint": self.turn_fingerprint(messages),
+                "retrieved_context": retrieved_context,
+                "point_ids": point_ids,
+                "history": [
+                    {
+                        "message": msg.message,
+                        "response": msg.response,
+                        "created_at": msg.created_at.isoformat(),
+                    }
+                    for msg in history
+                ],
+            }
+            await self.redis_client.set(
+                prewarm_key, json.dumps(data), ex=settings.BUFFER_TIMEOUT_MAX + 60
+            )
+            logger.debug(f"Prewarmed context for chat {chat_id}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error prewarming context for chat {chat_id}: {str(e)}")
 
     async def add_message_to_buffer(self, chat_request: ChatRequest, content: str):
         try:
             buffer_key = self.BUFFER_KEY.format(chat_id=chat_request.chat_id)
-            timer_key = self.TIMER_KEY.format(chat_id=chat_request.chat_id)
+            stats_key = self.STATS_KEY.format(chat_id=chat_request.chat_id)
+            inflight_key = self.INFLIGHT_KEY.format(chat_id=chat_request.chat_id)
 
             message_data = {
+                "id": uuid.uuid4().hex,
                 "chat_id": chat_request.chat_id,
                 "user_id": chat_request.user_id,
                 "message": content,
             }
 
-            pipe = self.redis_client.pipeline()
-            pipe.lpush(buffer_key, json.dumps(message_data))
-
-            # set timer
-            expire_at = datetime.now() + timedelta(seconds=self.buffer_timeout)
-            pipe.set(
-                timer_key, expire_at.isoformat()
-            )  # now for example 10:47:00 + 00:01:30 = 10h:48m:30s   1:30m
-
-            # Redis TTL - Time to live
-            pipe.expire(
-                buffer_key, self.buffer_timeout + 30
-            )  # !! think about it // 00:01:30 + 00:01:00 = 00h:02m:30s  2:30m
-            pipe.expire(
-                timer_key, self.buffer_timeout + 30
-            )  # !! // 00:01:30 + 00:00:30 = 00h:02m:00s 2:00m
+            # push + adaptive deadline + TTL in one round trip
+            buffer_size, expire_at, window = await self.append_message(
+                keys=[buffer_key, self.DEADLINES_KEY, stats_key, inflight_key],
+                args=[
+                    chat_request.chat_id,
+                    json.dumps(message_data),
+                    self.buffer_timeout,
+                    settings.BUFFER_TIMEOUT_MIN,
+                    settings.BUFFER_TIMEOUT_MAX,
+                    settings.BUFFER_TIMEOUT_QUESTION,
+                    settings.BUFFER_GAP_FACTOR,
+                    settings.BUFFER_GAP_ALPHA,
+                    1 if is_complete_question(content) else 0,
+                    self.buffer_ttl,
+                    self.DEADLINES_CHANNEL,
+                    86400,
+                    settings.BUFFER_TIMEOUT_SINGLE,
+                    settings.BUFFER_BURST_THRESHOLD,
+                ],
+            )
+            expire_at = float(expire_at)
+            metrics.observe("buffer_window_seconds", float(window))
 
-            results = await pipe.execute()
-            buffer_size = results[0]
+            self.schedule_prewarm(chat_id=chat_request.chat_id)
 
             logger.info(
                 f"Added message to Redis buffer for chat {chat_request.chat_id}. "
-                f"Buffer size: {buffer_size}, expires at: {expire_at.strftime('%H:%M:%S')}"
+                f"Buffer size: {buffer_size}, window: {float(window):.1f}s, "
+                f"expires at: {datetime.fromtimestamp(expire_at, ALMATY_TZ).strftime('%H:%M:%S')}"
             )
 
         except Exception as e:
@@ -559,5 +772,11 @@ class RedisHelper:
 
 
 redis_helper = RedisHelper(
-    redis_url=settings.REDIS_URL, buffer_timeout=settings.BUFFER_TIMEOUT
+    redis_url=settings.REDIS_URL,
+    buffer_timeout=settings.BUFFER_TIMEOUT,
+    max_workers=settings.BUFFER_MAX_WORKERS,
+    claim_idle_seconds=settings.BUFFER_CLAIM_IDLE,
+    lock_seconds=settings.BUFFER_LOCK_TIMEOUT,
+    queue_wait_seconds=settings.BUFFER_QUEUE_WAIT_MAX,
+    max_attempts=settings.BUFFER_MAX_ATTEMPTS,
 )
@@ -0,0 +1,209 @@
+"""Lua scripts executed server-side by RedisHelper"""
+
+# Move every due chat from the deadline index to the work stream.
+# KEYS[1] - deadlines sorted set, KEYS[2] - work stream
+# ARGV[1] - max chats per call, ARGV[2] - approximate stream MAXLEN
+# Returns {published chat ids, server time, next deadline or false}; times
+# are strings so Lua does not truncate them to integers.
+PUBLISH_DUE_BUFFERS = """
+local now = redis.call('TIME')
+local now_ts = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now_ts, 'WITHSCORES', 'LIMIT', 0, tonumber(ARGV[1]))
+local published = {}
+for i = 1, #due, 2 do
+    local chat_id = due[i]
+    redis.call('ZREM', KEYS[1], chat_id)
+    redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[2], '*', 'chat_id', chat_id, 'due_at', due[i + 1])
+    table.insert(published, chat_id)
+end
+local next_due = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+local next_ts = false
+if #next_due > 0 then
+    next_ts = next_due[2]
+end
+return {published, tostring(now_ts), next_ts}
+"""
+
+# Append a message to a chat buffer, (re)start its debounce window and
+# announce the new deadline to the schedulers.
+# The window adapts per chat. Across turns the chat keeps an EWMA of how
+# often a turn was a burst: more than one message, or a message sent while
+# the previous turn was still being processed. A chat without that history
+# or one that rarely bursts gets the short single-message window; a bursty
+# chat waits for the EWMA of the gaps inside its bursts (times the gap
+# multiplier), or the default window until such a gap is seen. Once a second
+# message lands in the buffer the chat is bursting right now and the burst
+# window applies. The window is clamped to [min, max] and shortened for a
+# buffer that holds a single complete question.
+# KEYS[1] - chat buffer list, KEYS[2] - deadlines sorted set,
+# KEYS[3] - chat stats hash, KEYS[4] - chat in-flight list
+# ARGV[1] - chat id, ARGV[2] - message json, ARGV[3] - default window,
+# ARGV[4] - min window, ARGV[5] - max window, ARGV[6] - question window,
+# ARGV[7] - gap multiplier, ARGV[8] - EWMA alpha,
+# ARGV[9] - 1 if the message is a complete question, ARGV[10] - buffer TTL,
+# ARGV[11] - deadline pub/sub channel, ARGV[12] - stats TTL,
+# ARGV[13] - single-message window, ARGV[14] - burst EWMA threshold
+# Returns {buffer size, deadline, window}, numbers as strings.
+APPEND_MESSAGE = """
+local now = redis.call('TIME')
+local now_ts = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local min_window = tonumber(ARGV[4])
+local max_window = tonumber(ARGV[5])
+local alpha = tonumber(ARGV[8])
+
+local size = redis.call('LPUSH', KEYS[1], ARGV[2])
+local last_ts = tonumber(redis.call('HGET', KEYS[3], 'last_ts'))
+local gap_ewma = tonumber(redis.call('HGET', KEYS[3], 'gap_ewma'))
+local burst_ewma = tonumber(redis.call('HGET', KEYS[3], 'burst_ewma'))
+
+if size == 1 then
+    -- a new turn: score the previous one
+    local turn_size = tonumber(redis.call('HGET', KEYS[3], 'turn_size'))
+    local in_flight = redis.call('EXISTS', KEYS[4]) == 1
+    if turn_size or in_flight then
+        local burst = 0
+        if in_flight or turn_size > 1 then
+            burst = 1
+        end
+        if burst_ewma then
+            burst_ewma = alpha * burst + (1 - alpha) * burst_ewma
+        else
+            burst_ewma = burst
+        end
+    end
+elseif last_ts then
+    -- a gap inside a burst
+    local gap = now_ts - last_ts
+    if gap >= 0 and gap <= max_window then
+        if gap_ewma then
+            gap_ewma = alpha * gap + (1 - alpha) * gap_ewma
+        else
+            gap_ewma = gap
+        end
+    end
+end
+
+local window
+if size == 1 and (not burst_ewma or burst_ewma < tonumber(ARGV[14])) then
+    window = tonumber(ARGV[13])
+elseif gap_ewma then
+    window = gap_ewma * tonumber(ARGV[7])
+else
+    window = tonumber(ARGV[3])
+end
+window = math.max(min_window, math.min(max_window, window))
+if size == 1 and ARGV[9] == '1' then
+    window = math.min(window, tonumber(ARGV[6]))
+end
+
+local expire_at = now_ts + window
+redis.call('ZADD', KEYS[2], expire_at, ARGV[1])
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[10]))
+
+redis.call('HSET', KEYS[3], 'last_ts', tostring(now_ts), 'turn_size', size)
+if gap_ewma then
+    redis.call('HSET', KEYS[3], 'gap_ewma', tostring(gap_ewma))
+end
+if burst_ewma then
+    redis.call('HSET', KEYS[3], 'burst_ewma', tostring(burst_ewma))
+end
+redis.call('EXPIRE', KEYS[3], tonumber(ARGV[12]))
+
+redis.call('PUBLISH', ARGV[11], tostring(expire_at))
+return {size, tostring(expire_at), tostring(window)}
+"""
+
+# Move everything buffered for a chat to its in-flight list and count the attempt.
+# Messages left in flight by a failed attempt are kept in front, so a retry
+# sees the whole turn. Messages appended afterwards land in a fresh buffer.
+# The TTL and the turn id are set once, when the turn starts, so retries
+# never extend the TTL and keep resuming the same turn.
+# KEYS[1] - chat buffer list, KEYS[2] - chat in-flight list, KEYS[3] - chat turn hash
+# ARGV[1] - in-flight TTL seconds
+# Returns {in-flight messages oldest first, attempt number, turn id}.
+DRAIN_BUFFER = """
+local new_turn = redis.call('EXISTS', KEYS[2]) == 0
+local items = redis.call('LRANGE', KEYS[1], 0, -1)
+for i = #items, 1, -1 do
+    redis.call('RPUSH', KEYS[2], items[i])
+end
+redis.call('DEL', KEYS[1])
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    return {{}, 0, false}
+end
+if new_turn then
+    redis.call('DEL', KEYS[3])
+    redis.call('EXPIRE', KEYS[2], tonumber(ARGV[1]))
+end
+local attempt = redis.call('HINCRBY', KEYS[3], 'attempts', 1)
+if redis.call('TTL', KEYS[3]) < 0 then
+    redis.call('EXPIRE', KEYS[3], tonumber(ARGV[1]))
+end
+local turn_id = redis.call('HGET', KEYS[3], 'turn_id')
+if not turn_id then
+    local now = redis.call('TIME')
+    turn_id = now[1] .. '-' .. now[2]
+    redis.call('HSET', KEYS[3], 'turn_id', turn_id)
+end
+return {redis.call('LRANGE', KEYS[2], 0, -1), attempt, turn_id}
+"""
+
+# Queue an outbound Omnidesk action (reply, manager call) for a chat.
+# Entries of one chat are delivered in order; the chat is due right away
+# unless it is already scheduled (being sent or backing off).
+# KEYS[1] - chat outbox list, KEYS[2] - outbox due sorted set,
+# KEYS[3] - idempotency marker
+# ARGV[1] - chat id, ARGV[2] - entry json, ARGV[3] - marker TTL seconds
+# Returns 1 if queued, 0 if an entry with this idempotency key was queued before.
+OUTBOX_ENQUEUE = """
+if not redis.call('SET', KEYS[3], '1', 'NX', 'EX', tonumber(ARGV[3])) then
+    return 0
+end
+redis.call('RPUSH', KEYS[1], ARGV[2])
+local now = redis.call('TIME')
+redis.call('ZADD', KEYS[2], 'NX', tonumber(now[1]) + tonumber(now[2]) / 1000000, ARGV[1])
+return 1
+"""
+
+# Lease due chats to one sender: their score moves a lease ahead, so another
+# replica picks a chat up again only if this sender dies mid-delivery.
+# KEYS[1] - outbox due sorted set
+# ARGV[1] - max chats, ARGV[2] - lease seconds
+# Returns {leased chat ids, server time, earliest score left or false}; times
+# are strings so Lua does not truncate them to integers.
+OUTBOX_CLAIM = """
+local now = redis.call('TIME')
+local now_ts = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now_ts, 'LIMIT', 0, tonumber(ARGV[1]))
+for _, chat_id in ipairs(due) do
+    redis.call('ZADD', KEYS[1], 'XX', now_ts + tonumber(ARGV[2]), chat_id)
+end
+local next_due = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+local next_ts = false
+if #next_due > 0 then
+    next_ts = next_due[2]
+end
+return {due, tostring(now_ts), next_ts}
+"""
+
+# Extend the lease of a chat that is still being delivered.
+# KEYS[1] - outbox due sorted set
+# ARGV[1] - chat id, ARGV[2] - lease seconds
+OUTBOX_RENEW = """
+local now = redis.call('TIME')
+return redis.call('ZADD', KEYS[1], 'XX', 'CH', tonumber(now[1]) + tonumber(now[2]) / 1000000 + tonumber(ARGV[2]), ARGV[1])
+"""
+
+# Give a leased chat back: drop it from the schedule if its outbox is empty,
+# otherwise make it due again after ARGV[2] seconds.
+# KEYS[1] - chat outbox list, KEYS[2] - outbox due sorted set
+# ARGV[1] - chat id, ARGV[2] - delay seconds
+OUTBOX_RELEASE = """
+if redis.call('LLEN', KEYS[1]) == 0 then
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    return 0
+end
+local now = redis.call('TIME')
+redis.call('ZADD', KEYS[2], tonumber(now[1]) + tonumber(now[2]) / 1000000 + tonumber(ARGV[2]), ARGV[1])
+return 1
+"""
@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+from app.models import answer_cache as answer_cache_module
+from app.models.answer_cache import AnswerCache, personal_content
+
+
+@pytest.mark.parametrize(
+    "answer, reason",
+    [
+        ("Как изменить реквизиты компании? Откройте Настройки → Компания.", None),
+        ("Рабочее время поддержки: с 9:00 до 18:00, 28.05.2023 было исключением.", None),
+        ("Добрый день, Айгерим! Откройте Настройки.", "name"),
+        ("Договор по БИН 123456789012 подписан.", "number"),
+        ("Позвоните нам: +7 (701) 123-45-67.", "number"),
+        ("Инструкция: https://trustme.kz/help/sms", "link"),
+        ("Напишите на aigerim@company.kz", "email"),
+    ],
+)
+def test_personal_content(answer, reason):
+    assert personal_content("Как изменить реквизиты?", answer) == reason
+
+
+def test_collection_created_by_another_replica_is_picked_up(monkeypatch):
+    exists = False
+    checks = []
+
+    class Client:
+        async def collection_exists(self, name):
+            checks.append(name)
+            return exists
+
+    monkeypatch.setattr(answer_cache_module.qdrant_helper, "qdrant_client", Client())
+    cache = AnswerCache(collection_name="answers", threshold=0.95, ttl=60, recheck_interval=0)
+
+    async def scenario():
+        nonlocal exists
+        assert await cache.check_collection() is False
+        exists = True
+        assert await cache.check_collection() is True
+        # once found it is not asked again
+        assert await cache.check_collection() is True
+
+    asyncio.run(scenario())
+    assert len(checks) == 2
@@ -0,0 +1,39 @@
+import asyncio
+
+from app.models import catalog_index as catalog_index_module
+from app.models.catalog_index import CatalogIndex
+from app.models.qdrant_helper import JINA_MODEL, OPENAI_MODEL
+
+CATALOG = '"1": "Не приходит смс",\n"2": "Ошибка подписи"'
+
+
+def test_index_built_by_fallback_is_rebuilt_for_primary_model(monkeypatch):
+    vectors = {"Не приходит смс": [1.0, 0.0], "Ошибка подписи": [0.0, 1.0]}
+    model = OPENAI_MODEL
+
+    async def embed_many_with_model(texts):
+        return [vectors[text] for text in texts], model
+
+    monkeypatch.setattr(
+        catalog_index_module.qdrant_helper, "embed_many_with_model", embed_many_with_model
+    )
+    index = CatalogIndex(catalog=CATALOG)
+
+    async def scenario():
+        nonlocal model
+        await index.build()
+        assert index.model == OPENAI_MODEL
+        assert [label_id for label_id, _, _ in await index.top_k([1.0, 0.0], model=OPENAI_MODEL)] == ["1", "2"]
+
+        # Jina is back: same dimensions, different space - no matches until rebuilt
+        model = JINA_MODEL
+        assert await index.top_k([1.0, 0.0], model=JINA_MODEL) == []
+        await index.rebuild_task
+        assert index.model == JINA_MODEL
+        assert (await index.top_k([1.0, 0.0], model=JINA_MODEL))[0][0] == "1"
+
+        # a fallback query against the primary index is skipped, not rebuilt
+        assert await index.top_k([1.0, 0.0], model=OPENAI_MODEL) == []
+        assert index.rebuild_task.done() and index.model == JINA_MODEL
+
+    asyncio.run(scenario())
@@ -0,0 +1,30 @@
+import asyncio
+import io
+
+from app.api.v1.chatbot import chatbot
+from app.schemas.chat import ChatRequest
+
+
+def test_failed_attachment_does_not_drop_the_others(monkeypatch):
+    async def download_attachments(urls):
+        return [("ok.png", io.BytesIO(b"ok")), ("broken.png", io.BytesIO(b"broken"))]
+
+    async def describe_image(file):
+        if file.read() == b"broken":
+            raise RuntimeError("vision call failed")
+        return "на image показан экран входа"
+
+    async def get_cached(*args):
+        return None
+
+    async def set_cached(*args):
+        pass
+
+    monkeypatch.setattr(chatbot.omnidesk_api, "download_attachments", download_attachments)
+    monkeypatch.setattr(chatbot, "describe_image", describe_image)
+    monkeypatch.setattr(chatbot.redis_helper, "get_attachment_content", get_cached)
+    monkeypatch.setattr(chatbot.redis_helper, "set_attachment_content", set_cached)
+
+    request = ChatRequest(chat_id="42", user_id="7", last_message="https://x/ok.png https://x/broken.png")
+    content = asyncio.run(chatbot.get_content_by_msg_type("image", request))
+    assert content == "на image показан экран входа"
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+from fakeredis import FakeServer
+from fakeredis.aioredis import FakeRedis
+
+from app.models import outbox as outbox_module
+from app.models.outbox import Outbox
+
+
+@pytest.fixture
+def make_outbox(monkeypatch):
+    server = FakeServer()
+    monkeypatch.setattr(
+        outbox_module.redis,
+        "from_url",
+        lambda url, **kwargs: FakeRedis(server=server, **kwargs),
+    )
+    return lambda **kwargs: Outbox(redis_url="redis://test", **kwargs)
+
+
+def test_slow_delivery_keeps_its_lease(make_outbox, monkeypatch):
+    delivered = []
+
+    async def deliver(entry):
+        # slower than the lease, e.g. queued behind the rate limiter
+        await asyncio.sleep(0.6)
+        delivered.append(entry["id"])
+        return 200
+
+    sender, other = make_outbox(lease_seconds=0.2), make_outbox(lease_seconds=0.2)
+    monkeypatch.setattr(sender, "deliver", deliver)
+
+    async def scenario():
+        await sender.start()
+        await sender.enqueue(chat_id="42", kind="message", key="k1", content="Ответ")
+        claimed = []
+        # another replica keeps trying to lease the chat while it is being sent
+        for _ in range(12):
+            await asyncio.sleep(0.05)
+            chat_ids, _, _ = await other.claim_chats(keys=[other.DUE_KEY], args=[10, 0.2])
+            claimed.extend(chat_ids)
+        await asyncio.sleep(0.3)
+        await sender.stop()
+        return claimed
+
+    assert asyncio.run(scenario()) == []
+    assert delivered == ["k1"]
+
+
+def test_idle_sender_does_not_poll(make_outbox, monkeypatch):
+    outbox = make_outbox()
+    claims = []
+    claim_chats = outbox.claim_chats
+
+    async def counting_claim(**kwargs):
+        claims.append(kwargs)
+        return await claim_chats(**kwargs)
+
+    monkeypatch.setattr(outbox, "claim_chats", counting_claim)
+
+    async def scenario():
+        await outbox.start()
+        await asyncio.sleep(1.5)
+        await outbox.stop()
+
+    asyncio.run(scenario())
+    assert len(claims) == 1
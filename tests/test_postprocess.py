@@ -0,0 +1,39 @@
+import pytest
+
+from app.api.v1.chatbot.postprocess import GREETING, postprocess_response
+
+
+def test_adds_greeting_to_russian_answer():
+    assert postprocess_response("Какая ошибка появляется?", recent_greeting=False) == (
+        f"{GREETING}\n\nКакая ошибка появляется?"
+    )
+
+
+@pytest.mark.parametrize(
+    "answer",
+    [
+        "Қандай қате шығады? Скриншот жіберіңізші.",
+        "What error do you see? Please send a screenshot.",
+    ],
+)
+def test_leaves_greeting_of_other_languages_to_llm(answer):
+    assert postprocess_response(answer, recent_greeting=False) is None
+
+
+@pytest.mark.parametrize(
+    "answer",
+    [
+        "Здравствуйте! Я AI-ассистент TrustMe. Какая ошибка появляется?",
+        "Қайырлы күн! Мен AI-ассистент TrustMe. Қандай қате шығады?",
+        "Hello! I'm the TrustMe AI assistant. What error do you see?",
+    ],
+)
+def test_strips_greeting_and_intro_after_recent_greeting(answer):
+    cleaned = postprocess_response(answer, recent_greeting=True)
+    assert cleaned == answer.split(". ", 1)[1]
+
+
+def test_strips_markdown():
+    assert postprocess_response("Здравствуйте!\n* **шаг** 1", recent_greeting=False) == (
+        "Здравствуйте!\n- шаг 1"
+    )
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+from fakeredis.aioredis import FakeRedis
+
+from app.models.qdrant_helper import JINA_MODEL, OPENAI_MODEL, QdrantHelper
+
+
+@pytest.fixture
+def helper():
+    helper = QdrantHelper()
+    helper.embedding_cache.redis_client = FakeRedis()
+    calls = []
+
+    def provider(value: float, fail: bool = False):
+        async def embed(inputs):
+            calls.append((value, list(inputs)))
+            if fail:
+                raise RuntimeError("provider down")
+            return [[value] * 4 for _ in inputs]
+
+        return embed
+
+    helper.calls = calls
+    helper.provider = provider
+    helper.providers = {
+        "jina": (provider(1.0), JINA_MODEL),
+        "openai": (provider(2.0), OPENAI_MODEL),
+    }
+    return helper
+
+
+def test_vector_cached_during_outage_is_not_served_after_recovery(helper):
+    async def scenario():
+        await helper.embedding_cache.set_many(OPENAI_MODEL, {"не приходит смс": [2.0] * 4})
+        return await helper.embed_query("не приходит смс")
+
+    embedding, model = asyncio.run(scenario())
+    assert model == JINA_MODEL
+    assert embedding == [1.0] * 4
+    assert helper.calls == [(1.0, ["не приходит смс"])]
+
+
+def test_cached_vector_is_reused(helper):
+    async def scenario():
+        first = await helper.embed_query("не приходит смс")
+        second = await helper.embed_query("Не приходит  СМС")
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first == second == ([1.0] * 4, JINA_MODEL)
+    assert len(helper.calls) == 1
+
+
+def test_open_breaker_serves_the_fallback_model_from_cache(helper):
+    for _ in range(helper.breakers["jina"].failure_threshold):
+        helper.breakers["jina"].record_failure()
+
+    async def scenario():
+        await helper.embedding_cache.set_many(OPENAI_MODEL, {"не приходит смс": [2.0] * 4})
+        return await helper.embed_query("не приходит смс")
+
+    assert asyncio.run(scenario()) == ([2.0] * 4, OPENAI_MODEL)
+    assert helper.calls == []
+
+
+def test_batch_never_mixes_models(helper):
+    # "a" is cached under Jina, but Jina fails for the rest of the batch
+    helper.providers["jina"] = (helper.provider(1.0, fail=True), JINA_MODEL)
+
+    async def scenario():
+        await helper.embedding_cache.set_many(JINA_MODEL, {"a": [1.0] * 4})
+        return await helper.embed_many_with_model(["a", "b", "a"])
+
+    embeddings, model = asyncio.run(scenario())
+    assert model == OPENAI_MODEL
+    assert embeddings == [[2.0] * 4] * 3
+
+
+def test_stored_vectors_of_another_model_are_re_embedded(helper):
+    queries, model = asyncio.run(
+        helper.fill_embeddings(
+            ["a", "b", "c"],
+            [[1.0] * 4, [2.0] * 4, [9.0] * 4],
+            [JINA_MODEL, OPENAI_MODEL, None],
+        )
+    )
+    assert model == JINA_MODEL
+    assert queries == [[1.0] * 4] * 3
+    # only the vectors that could not be reused were embedded
+    assert helper.calls == [(1.0, ["b", "c"])]
@@ -0,0 +1,258 @@
+import asyncio
+import json
+
+import pytest
+from fakeredis import FakeServer
+from fakeredis.aioredis import FakeRedis
+
+from app.models import redis_helper as redis_helper_module
+from app.models.redis_helper import RedisHelper
+from app.schemas.chat import ChatRequest
+
+
+@pytest.fixture
+def helper(monkeypatch):
+    server = FakeServer()
+    monkeypatch.setattr(
+        redis_helper_module.redis,
+        "from_url",
+        lambda url, **kwargs: FakeRedis(server=server, **kwargs),
+    )
+    helper = RedisHelper(redis_url="redis://test", buffer_timeout=90, max_workers=2)
+    # pre-warming talks to Postgres and Qdrant
+    monkeypatch.setattr(helper, "schedule_prewarm", lambda chat_id: None)
+    return helper
+
+
+def chat_request(chat_id: str, message: str) -> ChatRequest:
+    return ChatRequest(chat_id=chat_id, user_id="7", last_message=message)
+
+
+async def make_due(helper: RedisHelper, chat_id: str):
+    await helper.redis_client.zadd(helper.DEADLINES_KEY, {chat_id: await helper.redis_now() - 1})
+
+
+async def read_stream(helper: RedisHelper) -> list:
+    response = await helper.redis_client.xreadgroup(
+        groupname=helper.STREAM_GROUP,
+        consumername=helper.consumer_name,
+        streams={helper.STREAM_KEY: ">"},
+        count=10,
+    )
+    return [entry for _, entries in response or [] for entry in entries]
+
+
+def test_buffer_from_append_to_flush(helper, monkeypatch):
+    flushed = []
+
+    async def concatenate_process_and_save(messages, turn_id):
+        flushed.append(messages)
+        return True
+
+    monkeypatch.setattr(helper, "concatenate_process_and_save", concatenate_process_and_save)
+
+    async def scenario():
+        await helper.ensure_consumer_group()
+        await helper.add_message_to_buffer(chat_request("42", "привет"), "привет")
+        await helper.add_message_to_buffer(chat_request("42", "не приходит смс"), "не приходит смс")
+        await make_due(helper, "42")
+
+        published, _, _ = await helper.process_expired_buffers()
+        assert published == 1
+        [(entry_id, fields)] = await read_stream(helper)
+        assert fields["chat_id"] == "42"
+
+        task = helper.schedule_chat_buffer(
+            chat_id=fields["chat_id"], due_at=float(fields["due_at"]), entry_id=entry_id
+        )
+        assert await task is True
+
+        pending = await helper.redis_client.xpending(helper.STREAM_KEY, helper.STREAM_GROUP)
+        assert pending["pending"] == 0
+        assert not await helper.redis_client.exists(
+            helper.BUFFER_KEY.format(chat_id="42"),
+            helper.INFLIGHT_KEY.format(chat_id="42"),
+            helper.TURN_KEY.format(chat_id="42"),
+            helper.PROCESSING_KEY.format(chat_id="42"),
+        )
+
+    asyncio.run(scenario())
+
+    [messages] = flushed
+    assert [message["message"] for message in messages] == ["привет", "не приходит смс"]
+    assert messages[0]["chat_id"] == "42"
+
+
+def test_failed_flush_keeps_messages_in_flight(helper, monkeypatch):
+    async def concatenate_process_and_save(messages, turn_id):
+        return False
+
+    monkeypatch.setattr(helper, "concatenate_process_and_save", concatenate_process_and_save)
+
+    async def scenario():
+        await helper.add_message_to_buffer(chat_request("42", "привет"), "привет")
+        await make_due(helper, "42")
+        await helper.process_expired_buffers()
+
+        assert await helper.run_chat_buffer(chat_id="42", due_at=0.0) is False
+
+        inflight = await helper.redis_client.lrange(helper.INFLIGHT_KEY.format(chat_id="42"), 0, -1)
+        assert [json.loads(item)["message"] for item in inflight] == ["привет"]
+        # requeued for another attempt
+        assert await helper.redis_client.zscore(helper.DEADLINES_KEY, "42") is not None
+
+    asyncio.run(scenario())
+
+
+def test_buffer_outlives_queue_wait_and_lock(helper, monkeypatch):
+    async def concatenate_process_and_save(messages, turn_id):
+        return False
+
+    monkeypatch.setattr(helper, "concatenate_process_and_save", concatenate_process_and_save)
+    budget = helper.queue_wait_seconds + helper.lock_seconds
+
+    async def scenario():
+        await helper.add_message_to_buffer(chat_request("42", "привет"), "привет")
+        assert await helper.redis_client.ttl(helper.BUFFER_KEY.format(chat_id="42")) > budget
+
+        await helper.process_chat_buffer(chat_id="42")
+        assert await helper.redis_client.ttl(helper.INFLIGHT_KEY.format(chat_id="42")) > budget
+
+    asyncio.run(scenario())
+
+
+def test_failing_turn_is_dead_lettered_after_max_attempts(helper, monkeypatch):
+    attempts = []
+
+    async def concatenate_process_and_save(messages, turn_id):
+        attempts.append(messages)
+        if len(attempts) == 1:
+            raise RuntimeError("LLM call failed")
+        return False
+
+    monkeypatch.setattr(helper, "concatenate_process_and_save", concatenate_process_and_save)
+    inflight_key = helper.INFLIGHT_KEY.format(chat_id="42")
+
+    async def scenario():
+        await helper.add_message_to_buffer(chat_request("42", "привет"), "привет")
+        for attempt in range(1, helper.max_attempts + 1):
+            assert await helper.process_chat_buffer(chat_id="42") is False
+            if attempt < helper.max_attempts:
+                # requeued even when the turn raised
+                assert await helper.redis_client.zscore(helper.DEADLINES_KEY, "42") is not None
+                await helper.redis_client.zrem(helper.DEADLINES_KEY, "42")
+            if 1 < attempt < helper.max_attempts:
+                # a retry does not extend the in-flight TTL
+                assert 0 < await helper.redis_client.ttl(inflight_key) <= 100
+            await helper.redis_client.expire(inflight_key, 100)
+
+        assert len(attempts) == helper.max_attempts
+        assert await helper.redis_client.zscore(helper.DEADLINES_KEY, "42") is None
+        assert not await helper.redis_client.exists(inflight_key, helper.TURN_KEY.format(chat_id="42"))
+        [entry] = await helper.redis_client.lrange(helper.DEAD_LETTER_KEY, 0, -1)
+        entry = json.loads(entry)
+        assert entry["attempts"] == helper.max_attempts
+        assert [message["message"] for message in entry["messages"]] == ["привет"]
+
+    asyncio.run(scenario())
+
+
+def test_debounce_window_follows_burst_history(helper):
+    windows = []
+
+    async def append(chat_id: str, message: str):
+        before = await helper.redis_now()
+        await helper.add_message_to_buffer(chat_request(chat_id, message), message)
+        windows.append(await helper.redis_client.zscore(helper.DEADLINES_KEY, chat_id) - before)
+
+    async def scenario():
+        # no history: a single message does not wait the full window
+        await append("1", "не приходит смс")
+        # a chat whose turns are mostly bursts keeps the long window
+        await helper.redis_client.hset(
+            helper.STATS_KEY.format(chat_id="2"), mapping={"burst_ewma": "0.9", "turn_size": "3"}
+        )
+        await append("2", "не приходит смс")
+        # a second message 30s later lands in the same buffer: the chat is bursting
+        # right now and waits for the gap times BUFFER_GAP_FACTOR
+        await helper.redis_client.hset(
+            helper.STATS_KEY.format(chat_id="1"), "last_ts", str(await helper.redis_now() - 30)
+        )
+        await append("1", "код не приходит")
+
+    asyncio.run(scenario())
+
+    single, bursty, bursting = windows
+    assert single == pytest.approx(redis_helper_module.settings.BUFFER_TIMEOUT_SINGLE, abs=1)
+    assert bursty == pytest.approx(90, abs=1)
+    assert bursting == pytest.approx(30 * redis_helper_module.settings.BUFFER_GAP_FACTOR, abs=1)
+
+
+def test_late_prewarm_is_not_used_by_a_repeated_question(helper, monkeypatch):
+    retrieved = []
+
+    async def retrieve_turn_context(chat_id, concatenated_messages):
+        retrieved.append(concatenated_messages)
+        return f"context {len(retrieved)}", [len(retrieved)], []
+
+    monkeypatch.setattr(helper, "retrieve_turn_context", retrieve_turn_context)
+    monkeypatch.setattr(redis_helper_module, "is_working_hours", lambda now: True)
+    inflight_key = helper.INFLIGHT_KEY.format(chat_id="42")
+    turn_key = helper.TURN_KEY.format(chat_id="42")
+
+    async def drain():
+        messages_json, _, _ = await helper.drain_buffer(
+            keys=[helper.BUFFER_KEY.format(chat_id="42"), inflight_key, turn_key],
+            args=[helper.inflight_ttl],
+        )
+        return [json.loads(item) for item in messages_json]
+
+    async def scenario():
+        await helper.add_message_to_buffer(chat_request("42", "?"), "?")
+        await helper.prewarm_turn_context(chat_id="42")
+        first = await drain()
+        prewarmed = await helper.load_prewarmed("42", helper.turn_fingerprint(first))
+        assert prewarmed["retrieved_context"] == "context 1"
+
+        # the pre-warm finished after the flush cleaned up and wrote its result back
+        late = await helper.redis_client.get(helper.PREWARM_KEY.format(chat_id="42"))
+        await helper.cleanup_redis_keys(chat_id="42")
+        await helper.redis_client.set(helper.PREWARM_KEY.format(chat_id="42"), late)
+
+        await helper.add_message_to_buffer(chat_request("42", "?"), "?")
+        second = await drain()
+        assert await helper.load_prewarmed("42", helper.turn_fingerprint(second)) is None
+
+    asyncio.run(scenario())
+
+
+def test_each_turn_gets_its_own_checkpoint_thread(helper, monkeypatch):
+    runs, deleted = [], []
+
+    class TurnRunner:
+        async def run(self, state, thread_id):
+            runs.append(thread_id)
+            if len(runs) <= helper.max_attempts:
+                raise RuntimeError("LLM call failed")
+            return {}
+
+        async def delete_thread(self, thread_id):
+            deleted.append(thread_id)
+
+    monkeypatch.setattr(redis_helper_module, "turn_runner", TurnRunner())
+    monkeypatch.setattr(redis_helper_module, "is_working_hours", lambda now: True)
+
+    async def scenario():
+        await helper.add_message_to_buffer(chat_request("42", "здравствуйте"), "здравствуйте")
+        for _ in range(helper.max_attempts):
+            assert await helper.process_chat_buffer(chat_id="42") is False
+        # a later turn with the same text does not resume the abandoned one
+        await helper.add_message_to_buffer(chat_request("42", "здравствуйте"), "здравствуйте")
+        assert await helper.process_chat_buffer(chat_id="42") is True
+
+    asyncio.run(scenario())
+
+    first, *retries, second = runs
+    assert retries == [first] * (helper.max_attempts - 1)
+    assert second != first
+    assert deleted == [first]